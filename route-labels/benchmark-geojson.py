@@ -0,0 +1,90 @@
+from optparse import OptionParser
+from StringIO import StringIO
+from json import JSONEncoder
+from random import uniform
+from re import compile
+from time import time
+
+import logging
+
+from geojsonwriter import write_feature_collection
+
+float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
+charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
+
+def regex_feature_collection(output, features, format):
+    '''
+    '''
+    # The previous token-by-token output from extract-*.py, kept for comparison.
+    geojson = dict(type='FeatureCollection', features=features)
+    encoder = JSONEncoder(separators=(',', ':'))
+    
+    for token in encoder.iterencode(geojson):
+        if charfloat_pat.match(token):
+            output.write(token[0] + format % float(token[1:]))
+        
+        elif float_pat.match(token):
+            output.write(format % float(token))
+        
+        else:
+            output.write(token)
+
+def synthetic_multiline(lines, points):
+    '''
+    '''
+    x, y = uniform(-180, 180), uniform(-80, 80)
+    coordinates = []
+    
+    for line in range(lines):
+        coordinates.append(tuple([(x + uniform(-.1, .1), y + uniform(-.1, .1)) for point in range(points)]))
+    
+    return dict(type='MultiLineString', coordinates=tuple(coordinates))
+
+def time_output(function, features, format):
+    '''
+    '''
+    output = StringIO()
+    start = time()
+    function(output, features, format)
+    
+    return output.getvalue(), time() - start
+
+optparser = OptionParser(usage="""%prog [options]
+
+Compares geojsonwriter.py with the previous JSONEncoder and regular
+expression output on large synthetic multilines.""")
+
+defaults = dict(features=20, lines=200, points=500, loglevel=logging.INFO)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('-f', '--features', dest='features', type='int',
+                     help='Number of features, default %(features)d.' % defaults)
+
+optparser.add_option('-l', '--lines', dest='lines', type='int',
+                     help='Lines per multiline, default %(lines)d.' % defaults)
+
+optparser.add_option('-n', '--points', dest='points', type='int',
+                     help='Points per line, default %(points)d.' % defaults)
+
+if __name__ == '__main__':
+
+    opts, args = optparser.parse_args()
+    
+    logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
+    
+    features = [dict(type='Feature', id=index, properties=dict(name='Street %d' % index),
+                     geometry=synthetic_multiline(opts.lines, opts.points))
+                for index in range(opts.features)]
+    
+    logging.info('%d features with %d coordinates each' % (opts.features, opts.lines * opts.points))
+    
+    for format in ('%.6f', '%.5f'):
+        old_output, old_elapsed = time_output(regex_feature_collection, features, format)
+        new_output, new_elapsed = time_output(write_feature_collection, features, format)
+        
+        assert old_output == new_output, 'Output differs at %s' % format
+        
+        logging.info('%s regex tokens: %.3f seconds' % (format, old_elapsed))
+        logging.info('%s geojsonwriter: %.3f seconds' % (format, new_elapsed))
+        logging.info('%s speedup: %.1fx' % (format, old_elapsed / max(new_elapsed, 1e-6)))
@@ -0,0 +1,114 @@
+from time import time
+from random import seed, uniform, random
+from optparse import OptionParser
+
+import logging
+
+from shapely.geometry import LineString
+
+extract = __import__('extract-routes')
+
+def pairwise_union(shapes):
+    '''
+    '''
+    # The previous cascaded_union() from extract-routes.py, kept for comparison.
+    if len(shapes) == 0:
+        return None
+    
+    if len(shapes) == 1:
+        return shapes[0]
+    
+    if len(shapes) == 2:
+        if shapes[0] and shapes[1]:
+            try:
+                return shapes[0].union(shapes[1])
+            except Exception, e:
+                logging.error(str(e))
+                
+                return None
+        
+        if shapes[0] is None:
+            return shapes[1]
+        
+        if shapes[1] is None:
+            return shapes[0]
+        
+        return None
+    
+    cut = len(shapes) / 2
+    
+    shapes1 = pairwise_union(shapes[:cut])
+    shapes2 = pairwise_union(shapes[cut:])
+    
+    return pairwise_union([shapes1, shapes2])
+
+def synthetic_route(ways, opts):
+    '''
+    '''
+    #
+    # A random walk cut into ways of a few points each, like a long
+    # highway route, with a fraction of ways repeated and reversed
+    # the way dual carriageways and shared segments show up.
+    #
+    x, y, lines = 0., 0., []
+    
+    for way in range(ways):
+        points = [(x, y)]
+        
+        for point in range(opts.points):
+            x, y = x + uniform(0, .001), y + uniform(-.001, .001)
+            points.append((x, y))
+        
+        lines.append(LineString(points))
+        
+        if random() < opts.repeats:
+            lines.append(LineString(points[::-1]))
+    
+    return lines
+
+def time_merge(merge, lines):
+    '''
+    '''
+    start = time()
+    merged = merge(lines)
+    
+    return merged, time() - start
+
+optparser = OptionParser(usage="""%prog [options]
+
+Compares merge_route() from extract-routes.py with the previous recursive
+pairwise union on synthetic routes of increasing way count.""")
+
+defaults = dict(sizes='10,100,1000,5000', points=8, repeats=.1, loglevel=logging.INFO)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('-s', '--sizes', dest='sizes',
+                     help='Comma-separated way counts to try, default "%(sizes)s".' % defaults)
+
+optparser.add_option('-n', '--points', dest='points', type='int',
+                     help='Points added per way, default %(points)d.' % defaults)
+
+optparser.add_option('-r', '--repeats', dest='repeats', type='float',
+                     help='Fraction of ways repeated in reverse, default %(repeats).2f.' % defaults)
+
+if __name__ == '__main__':
+
+    opts, args = optparser.parse_args()
+    
+    logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
+    
+    seed(0)
+    
+    for ways in map(int, opts.sizes.split(',')):
+        lines = synthetic_route(ways, opts)
+        
+        old_merged, old_elapsed = time_merge(pairwise_union, lines)
+        new_merged, new_elapsed = time_merge(extract.merge_route, lines)
+        dup_merged, dup_elapsed = time_merge(lambda lines: extract.merge_route(lines, True), lines)
+        
+        assert old_merged.equals(new_merged), 'Merged routes differ at %d ways' % ways
+        assert old_merged.equals(dup_merged), 'Deduped routes differ at %d ways' % ways
+        
+        logging.info('%d ways (%d lines): pairwise %.3f sec, bulk %.3f sec, bulk deduped %.3f sec, speedup %.1fx'
+                     % (ways, len(lines), old_elapsed, new_elapsed, dup_elapsed, old_elapsed / max(new_elapsed, 1e-6)))
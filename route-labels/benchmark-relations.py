@@ -0,0 +1,143 @@
+from time import time
+from optparse import OptionParser
+
+import logging
+
+from psycopg2 import connect
+
+extract = __import__('extract-routes')
+
+class CountingCursor:
+    ''' Cursor wrapper that counts calls to execute().
+    '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+    
+    def execute(self, *args):
+        self.queries += 1
+        return self.cursor.execute(*args)
+    
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def query_relation_ways(db, opts, rel_id):
+    '''
+    '''
+    # The previous per-relation traversal from extract-routes.py, kept for comparison.
+    rel_ids = [rel_id]
+    rels_seen = set()
+    way_ids = set()
+    
+    while rel_ids:
+        rel_id = rel_ids.pop(0)
+        
+        if rel_id in rels_seen:
+            break
+        
+        rels_seen.add(rel_id)
+        
+        db.execute('''SELECT members
+                      FROM %s_rels
+                      WHERE id = %d''' \
+                    % (opts.table_prefix, rel_id))
+        
+        try:
+            (members, ) = db.fetchone()
+        
+        except TypeError:
+            # missing relation
+            continue
+        
+        if not members:
+            continue
+        
+        for member in members[0::2]:
+            if member.startswith('r'):
+                rel_ids.append(int(member[1:]))
+            
+            elif member.startswith('w'):
+                way_ids.add(int(member[1:]))
+    
+    return way_ids
+
+def build_synthetic_table(db, opts):
+    '''
+    '''
+    # every route has opts.ways ways and one subrelation with as many more
+    ways = '''ARRAY(SELECT unnest(ARRAY['w' || (%d + r * 1000 + w), ''])
+                    FROM generate_series(1, %d) AS w)'''
+    
+    db.execute('''CREATE TEMPORARY TABLE %s_rels
+                  (id BIGINT PRIMARY KEY, members TEXT[], tags TEXT[])''' % opts.table_prefix)
+    
+    db.execute('''INSERT INTO %s_rels
+                  SELECT 100000000 + r, %s, ARRAY['type', 'route']
+                  FROM generate_series(1, %d) AS r''' \
+               % (opts.table_prefix, ways % (100000000, opts.ways), opts.relations))
+    
+    db.execute('''INSERT INTO %s_rels
+                  SELECT r, ARRAY['r' || (100000000 + r), 'forward'] || %s,
+                         ARRAY['type', 'route', 'network', 'US:I', 'ref', r::text]
+                  FROM generate_series(1, %d) AS r''' \
+               % (opts.table_prefix, ways % (0, opts.ways), opts.relations))
+    
+    db.execute('ANALYZE %s_rels' % opts.table_prefix)
+
+optparser = OptionParser(usage="""%prog [options] <database>
+
+Compares bulk relation traversal in extract-routes.py with the previous
+one-query-per-relation traversal on a synthetic rels table.""")
+
+defaults = dict(host='localhost', user='osm2pgsql', passwd=None, table_prefix='synthetic', relations=20000, ways=20, batch_size=10000, loglevel=logging.INFO)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('--host', dest='host',
+                     help='Postgres hostname, default %(host)s.' % defaults)
+
+optparser.add_option('-u', '--user', dest='user',
+                     help='Postgres username, default "%(user)s".' % defaults)
+
+optparser.add_option('-p', '--passwd', dest='passwd',
+                     help='Postgres password, default "%(passwd)s".' % defaults)
+
+optparser.add_option('-r', '--relations', dest='relations', type='int',
+                     help='Number of synthetic route relations, default %(relations)d.' % defaults)
+
+optparser.add_option('-w', '--ways', dest='ways', type='int',
+                     help='Ways per relation and per subrelation, default %(ways)d.' % defaults)
+
+optparser.add_option('--batch-size', dest='batch_size', type='int',
+                     help='Most relation IDs to look up per query, default %(batch_size)d.' % defaults)
+
+if __name__ == '__main__':
+
+    opts, (dbname, ) = optparser.parse_args()
+    
+    logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
+    
+    db = connect(host=opts.host, database=dbname, user=opts.user, password=opts.passwd)
+    db = CountingCursor(db.cursor())
+    
+    build_synthetic_table(db, opts)
+    rel_ids = range(1, opts.relations + 1)
+    
+    db.queries, start = 0, time()
+    old_ways = dict([(rel_id, query_relation_ways(db, opts, rel_id)) for rel_id in rel_ids])
+    old_queries, old_elapsed = db.queries, time() - start
+    
+    db.queries, start = 0, time()
+    index = extract.load_relation_index(db, opts, rel_ids)
+    new_ways = dict([(rel_id, extract.get_relation_ways(index, rel_id)) for rel_id in rel_ids])
+    new_queries, new_elapsed = db.queries, time() - start
+    
+    # the bulk traversal lists ways in member order, the old one collected a set
+    assert old_ways == dict([(rel_id, set(way_ids)) for (rel_id, way_ids) in new_ways.items()]), 'Way IDs differ'
+    
+    logging.info('%d relations with %d ways each' % (opts.relations, opts.ways * 2))
+    logging.info('Per-relation queries: %d queries in %.3f seconds' % (old_queries, old_elapsed))
+    logging.info('Bulk traversal: %d queries in %.3f seconds' % (new_queries, new_elapsed))
+    logging.info('Speedup: %.1fx' % (old_elapsed / max(new_elapsed, 1e-6)))
+    
+    db.close()
@@ -1,23 +1,120 @@
 from time import time
 from uuid import uuid1
-from bz2 import BZ2File
+from collections import OrderedDict
+from struct import unpack
 from itertools import count, izip, groupby
 from optparse import OptionParser
 from multiprocessing import Pool
-from json import JSONEncoder
-from re import compile
+from threading import BoundedSemaphore
 
 import logging
 
 from psycopg2 import connect
 from shapely.wkb import loads
+from shapely.ops import linemerge
+from geojsonwriter import CompressedOutput, write_feature_collection
+from extracttools import build_masks, spool_records, unspool_records, load_manifest, update_manifest
 
-float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
-charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
+try:
+    from shapely.ops import unary_union
+except ImportError:
+    # Shapely before 1.2.16 only has the older name
+    from shapely.ops import cascaded_union as unary_union
+
+def tag_value(key):
+    ''' SQL expression for the value of key in an osm2pgsql tags array.
+        
+        The last value wins, like dict(zip(keys, values)) in Python.
+    '''
+    return '''(SELECT tags[i + 1] FROM generate_subscripts(tags, 1) AS i
+               WHERE i %% 2 = 1 AND tags[i] = '%s' ORDER BY i DESC LIMIT 1)''' % key
+
+def route_candidates_query(opts):
+    ''' SQL for the same relations that get_relations_list() keeps from a full scan.
+    '''
+    return '''
+        SELECT id, tags, network, ref, COALESCE(modifier, '') AS modifier
+        FROM (
+            SELECT id, tags,
+                   %(network)s AS network,
+                   %(ref)s AS ref,
+                   %(modifier)s AS modifier,
+                   COALESCE(%(route)s, %(type)s, '') AS route,
+                   %(route_master)s AS route_master,
+                   COALESCE(%(line)s, '') AS line
+            FROM %(table_prefix)s_rels
+            WHERE 'network' = ANY(tags)
+              AND 'ref' = ANY(tags)
+        ) AS rels
+        WHERE network IS NOT NULL
+          AND ref IS NOT NULL
+          
+          -- Skip bike, walking
+          AND network NOT IN ('lcn', 'rcn', 'ncn', 'icn', 'mtb', 'lwn', 'rwn', 'nwn', 'iwn')
+          
+          -- Skip buses, trains
+          AND (CASE WHEN route = 'route_master' AND route_master IS NOT NULL
+                    THEN route_master ELSE route END)
+              NOT IN ('bus', 'bicycle', 'tram', 'train', 'subway', 'light_rail', 'trolleybus')
+          AND line != 'bus'
+        ''' % dict(table_prefix=opts.table_prefix,
+                   network=tag_value('network'), ref=tag_value('ref'),
+                   modifier=tag_value('modifier'), route=tag_value('route'),
+                   type=tag_value('type'), route_master=tag_value('route_master'),
+                   line=tag_value('line'))
+
+def refresh_route_table(db, opts):
+    ''' Create or refill the route candidate table named by opts.route_table.
+        
+        The refill happens in one transaction, so other extracts reading
+        the table keep seeing the previous rows until it's committed.
+    '''
+    table = opts.route_table
+    
+    db.execute("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'r'", (table, ))
+    
+    if not db.rowcount:
+        logging.info('Creating %s' % table)
+        
+        db.execute('''CREATE TABLE %s
+                      (
+                          id        BIGINT PRIMARY KEY,
+                          tags      TEXT[],
+                          network   TEXT,
+                          ref       TEXT,
+                          modifier  TEXT
+                      )''' % table)
+        
+        db.execute('CREATE INDEX %s_key ON %s (network, ref, modifier)' % (table, table))
+    
+    db.execute('DELETE FROM %s' % table)
+    db.execute('INSERT INTO %s (id, tags, network, ref, modifier) %s' % (table, route_candidates_query(opts)))
+    
+    logging.info('Refreshed %s with %d relations' % (table, db.rowcount))
+    
+    db.execute('ANALYZE %s' % table)
+    db.connection.commit()
 
 def get_relations_list(db, opts):
     '''
     '''
+    if opts.route_table:
+        #
+        # Exclusions were already applied when the table was filled,
+        # see route_candidates_query().
+        #
+        db.execute('SELECT id, tags, modifier FROM %s' % opts.route_table)
+        
+        relations = []
+        
+        for (id, tags, modifier) in db.fetchall():
+            tags = dict([keyval for keyval in zip(tags[0::2], tags[1::2])])
+            tags['modifier'] = modifier
+            
+            relations.append((id, tags))
+        
+        return relations
+    
     db.execute('''SELECT id, tags
                   FROM %s_rels
                   WHERE 'network' = ANY(tags)
@@ -62,162 +159,359 @@ def get_relations_list(db, opts):
     
     return relations
 
-def cascaded_union(shapes):
+def dedupe_lines(lines):
+    ''' Drop lines that repeat an earlier line's coordinates, in either direction.
     '''
-    '''
-    if len(shapes) == 0:
-        return None
+    seen, unique = set(), []
     
-    if len(shapes) == 1:
-        return shapes[0]
+    for line in lines:
+        coords = tuple(line.coords)
+        key = min(coords, coords[::-1])
+        
+        if key not in seen:
+            seen.add(key)
+            unique.append(line)
     
-    if len(shapes) == 2:
-        if shapes[0] and shapes[1]:
-            try:
-                return shapes[0].union(shapes[1])
-            except Exception, e:
-                logging.error(str(e))
+    return unique
 
-                return None
-        
-        if shapes[0] is None:
-            return shapes[1]
-        
-        if shapes[1] is None:
-            return shapes[0]
+def merge_route(lines, dedupe=False):
+    ''' Union a route's way lines in one pass and join them end-to-end.
         
+        Returns None for an empty route, and lets errors from GEOS
+        through so the caller can say which route they came from.
+    '''
+    lines = [line for line in lines if line]
+    
+    if dedupe:
+        lines = dedupe_lines(lines)
+    
+    if len(lines) == 0:
         return None
     
-    cut = len(shapes) / 2
+    if len(lines) == 1:
+        return lines[0]
     
-    shapes1 = cascaded_union(shapes[:cut])
-    shapes2 = cascaded_union(shapes[cut:])
+    merged = unary_union(lines)
     
-    return cascaded_union([shapes1, shapes2])
+    if merged.geom_type == 'MultiLineString':
+        # union nodes lines at every crossing, so sew the pieces back up
+        merged = linemerge(merged)
+    
+    return merged
 
 def relation_key((id, tags)):
     '''
     '''
     return (tags.get('network', ''), tags.get('ref', ''), tags.get('modifier', ''))
 
-def get_relation_ways(db, opts, rel_id):
+def load_relation_index(db, opts, rel_ids):
     '''
     '''
-    rel_ids = [rel_id]
-    rels_seen = set()
-    way_ids = set()
+    #
+    # Fetch members for a whole level of relations per query, first the
+    # routes themselves, then their subrelations, and so on down. Only
+    # ("r", id) and ("w", id) members are kept, in member order, not
+    # roles or node members.
+    #
+    index, pending = dict(), set(rel_ids)
     
-    while rel_ids:
-        rel_id = rel_ids.pop(0)
+    while pending:
+        ids, pending = sorted(pending), set()
         
-        if rel_id in rels_seen:
-            break
+        for offset in range(0, len(ids), opts.batch_size):
+            batch = ids[offset:offset + opts.batch_size]
+            
+            db.execute('''SELECT id, members
+                          FROM %s_rels
+                          WHERE id = ANY(%%s)''' % opts.table_prefix, (batch, ))
+            
+            for (rel_id, members) in db.fetchall():
+                members = members and members[0::2] or []
+                index[rel_id] = tuple([(member[0], int(member[1:])) for member in members if member[:1] in ('r', 'w')])
+            
+            for rel_id in batch:
+                # missing relations
+                index.setdefault(rel_id, ())
         
-        rels_seen.add(rel_id)
+        for members in index.values():
+            pending.update([id for (type, id) in members if type == 'r' and id not in index])
+    
+    return index
+
+def get_relation_ways(index, rel_id):
+    ''' List the way IDs of a relation and its subrelations, in member order.
         
-        db.execute('''SELECT members
-                      FROM %s_rels
-                      WHERE id = %d''' \
-                    % (opts.table_prefix, rel_id))
+        Subrelations are expanded where they appear among the members,
+        and each way is listed once, at its first appearance.
+    '''
+    members = [('r', rel_id)]
+    rels_seen, ways_seen = set(), set()
+    way_ids = []
+    
+    while members:
+        type, id = members.pop(0)
+        
+        if type == 'w':
+            if id not in ways_seen:
+                ways_seen.add(id)
+                way_ids.append(id)
         
-        try:
-            (members, ) = db.fetchone()
+        elif id not in rels_seen:
+            rels_seen.add(id)
+            members[0:0] = index.get(id, ())
+    
+    return way_ids
 
-        except TypeError:
-            # missing relation
-            continue
+class WayCache (object):
+    ''' Memory-bounded LRU cache of way geometries, keyed by way ID.
         
-        if not members:
-            continue
+        Ways shared between relations, like concurrent Interstate and US
+        routes or forward and backward relations, are read and parsed once.
+        Missing ways are cached as None so they aren't looked up again.
+    '''
+    def __init__(self, max_bytes):
+        self.ways = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits, self.misses = 0, 0
+    
+    def __contains__(self, way_id):
+        return way_id in self.ways
+    
+    def get(self, way_id):
+        # move to the most-recently-used end
+        line = self.ways.pop(way_id)
+        self.ways[way_id] = line
+        self.hits += 1
+        
+        return line
+    
+    def add(self, way_id, line):
+        self.ways[way_id] = line
+        self.bytes += self._size(line)
+        self.misses += 1
         
-        for member in members[0::2]:
-            if member.startswith('r'):
-                rel_ids.append(int(member[1:]))
+        while self.bytes > self.max_bytes and len(self.ways) > 1:
+            old_id, old_line = self.ways.popitem(last=False)
+            self.bytes -= self._size(old_line)
+    
+    def _size(self, line):
+        if line is None:
+            return 0
+        elif isinstance(line, str):
+            return len(line)
+        else:
+            # sixteen bytes per coordinate pair plus some object overhead
+            return 16 * count_coords(line) + 200
+    
+    def describe(self):
+        rate = float(self.hits) / max(self.hits + self.misses, 1)
+        return '%d hits, %d misses (%.1f%% hit rate), %d ways in %.1fMB' \
+               % (self.hits, self.misses, 100 * rate, len(self.ways), self.bytes / 1048576.)
+
+def get_way_linestrings(db, opts, cache, way_ids):
+    '''
+    '''
+    lines = dict([(way_id, cache.get(way_id)) for way_id in way_ids if way_id in cache])
+    missing = sorted([way_id for way_id in way_ids if way_id not in lines])
+    
+    if opts.bbox or opts.mask_file:
+        # an && test against the GiST-indexed masks table, see build_masks()
+        mask_test = 'AND EXISTS (SELECT 1 FROM masks WHERE masks.way && lines.way)'
+    else:
+        mask_test = ''
+    
+    for offset in range(0, len(missing), opts.batch_size):
+        batch = missing[offset:offset + opts.batch_size]
+        
+        db.execute('''SELECT osm_id, AsBinary(Transform(way, 4326))
+                      FROM %s_line AS lines
+                      WHERE osm_id = ANY(%%s) %s''' % (opts.table_prefix, mask_test), (batch, ))
+        
+        for (way_id, way_wkb) in db.fetchall():
+            if way_id in lines:
+                # a way split into several rows, keep the first like before
+                continue
             
-            elif member.startswith('w'):
-                way_ids.add(int(member[1:]))
+            if opts.transport == 'shapely':
+                lines[way_id] = loads(bytes(way_wkb))
+            else:
+                # leave decoding to the encoder processes
+                lines[way_id] = bytes(way_wkb)
+        
+        for way_id in batch:
+            cache.add(way_id, lines.setdefault(way_id, None))
     
-    return way_ids
+    return lines
 
-def get_way_linestring(db, opts, way_id):
+def count_coords(line):
     '''
     '''
-    db.execute('''SELECT AsBinary(Transform(way, 4326))
-                  FROM %s_line
-                  WHERE osm_id = %%s''' % opts.table_prefix, (way_id, ))
+    if not isinstance(line, str):
+        return len(line.coords)
     
-    if db.rowcount == 0:
-        return None
+    #
+    # Read the point count from a WKB LineString header without decoding
+    # the rest: byte order, geometry type, then number of points.
+    #
+    order = (line[0] == '\x01') and '<' or '>'
+    
+    if unpack(order + 'I', line[1:5])[0] != 2:
+        return len(loads(line).coords)
+    
+    return unpack(order + 'I', line[5:9])[0]
 
-    return loads(bytes(db.fetchone()[0]))
+def decoded_geometry(geom):
+    '''
+    '''
+    if isinstance(geom, str):
+        return loads(geom)
+    
+    return geom
 
-def gen_relation_groups(db, opts, relations):
+def split_ways(way_ids, lines, target):
+    ''' Cut a list of ways into runs of at most target vertices, in member order.
+        
+        Returns a list of (lines, vertices) tuples. A single way bigger
+        than target gets a run to itself.
+    '''
+    parts, part, part_coords = [], [], 0
+    
+    for way_id in way_ids:
+        coords = count_coords(lines[way_id])
+        
+        if part and part_coords + coords > target:
+            parts.append((part, part_coords))
+            part, part_coords = [], 0
+        
+        part.append(lines[way_id])
+        part_coords += coords
+    
+    if part:
+        parts.append((part, part_coords))
+    
+    return parts
+
+def gen_relation_groups(db, opts, relations, boundaries=()):
     '''
     '''
-    relations.sort(key=relation_key)
+    # in ID order within each key, so unchanged groups come out the same
+    relations.sort(key=lambda (id, tags): (relation_key((id, tags)), id))
+    
+    start = time()
+    index = load_relation_index(db, opts, [id for (id, tags) in relations])
+    
+    logging.info('Loaded members of %d relations in %.1f seconds' % (len(index), time() - start))
     
+    cache = WayCache(opts.way_cache * 1048576)
     group_list, group_coords = [], 0
     
-    for (key, _relations) in groupby(relations, relation_key):
+    #
+    # Keys in boundaries start a group no matter what, so that groups
+    # line up with the ones from a previous run, see load_manifest().
+    # Between those, groups are only closed at twice the target.
+    #
+    target = boundaries and 2 * opts.target_vertices or opts.target_vertices
     
-        rel_coords, way_lines = 0, []
-        
-        for (id, tags) in _relations:
-            way_ids = get_relation_ways(db, opts, id)
-            way_lines += [get_way_linestring(db, opts, way_id) for way_id in way_ids]
-            rel_coords += sum([len(line.coords) for line in way_lines if line])
-
-        logging.debug('%s -- %d nodes' % (', '.join(key), rel_coords))
-        
-        group_list.append((id, tags, way_lines))
-        group_coords += rel_coords
+    for (key, _relations) in groupby(relations, relation_key):
     
-        if group_coords > 100000:
+        if group_list and key in boundaries:
+            logging.debug('Group of %d routes, %d nodes' % (len(group_list), group_coords))
             yield group_list
             group_list, group_coords = [], 0
+        
+        # fetch every way for this key in one go
+        _relations = [(id, tags, get_relation_ways(index, id)) for (id, tags) in _relations]
+        lines = get_way_linestrings(db, opts, cache, set().union(*[way_ids for (i, t, way_ids) in _relations]))
+        
+        #
+        # Each way counts once per key, no matter how many of the key's
+        # relations share it, since that's how many times its vertices
+        # will be written out. Ways outside any mask have no line.
+        #
+        seen_ways, key_ways = set(), []
+        
+        for (id, tags, way_ids) in _relations:
+            for way_id in way_ids:
+                if way_id not in seen_ways and lines[way_id]:
+                    seen_ways.add(way_id)
+                    key_ways.append(way_id)
+        
+        parts = split_ways(key_ways, lines, opts.target_vertices)
+        
+        #
+        # Every part is written with the first relation's ID and tags.
+        # A key split into several parts gets "<id>-<n>" feature IDs,
+        # so that no two features share an ID.
+        #
+        key_id, key_tags = _relations[0][:2]
+        
+        logging.debug('%s -- %d nodes in %d parts' % (', '.join(key), sum([c for (l, c) in parts]), len(parts)))
+        
+        #
+        # Close the group before a part would push it over the target,
+        # so groups come out close to opts.target_vertices each.
+        #
+        for (number, (way_lines, part_coords)) in enumerate(parts):
+            if group_list and group_coords + part_coords > target:
+                logging.debug('Group of %d routes, %d nodes' % (len(group_list), group_coords))
+                logging.debug('Way cache: %s' % cache.describe())
+                yield group_list
+                group_list, group_coords = [], 0
+            
+            part_id = len(parts) > 1 and '%d-%d' % (key_id, number + 1) or key_id
+            group_list.append((part_id, key_tags, way_lines))
+            group_coords += part_coords
     
+    logging.info('Way cache: %s' % cache.describe())
     yield group_list
 
-def output_geojson_bzipped(index, routes):
+def output_geojson_bzipped(index, routes, dedupe=False):
     '''
     '''
+    output, digest, routes_count = None, None, 0
+    
     try:
-        ids = [id for (id, t, g) in routes]
-        geometries = [cascaded_union(geoms) for (i, t, geoms) in routes]
-        geometries = [geom.__geo_interface__ for geom in geometries if geom]
-        properties = [tags for (i, tags, g) in routes]
-        
-        features = [dict(type='Feature', id=id, properties=p, geometry=g)
-                    for (id, p, g) in zip(ids, properties, geometries)]
+        #
+        # Unspooling can fail too, and every exit has to reach the
+        # caller's callback so that its in-flight slot is given back.
+        #
+        if isinstance(routes, basestring):
+            # the name of a spool file, see spool_records()
+            routes = list(unspool_records(routes))
         
-        geojson = dict(type='FeatureCollection', features=features)
-        encoder = JSONEncoder(separators=(',', ':'))
-        encoded = encoder.iterencode(geojson)
-
-        output = BZ2File('routes-%06d.json.bz2' % index, 'w')
+        routes_count, features = len(routes), []
         
-        for token in encoded:
-            if charfloat_pat.match(token):
-                # in python 2.7, we see a character followed by a float literal
-                output.write(token[0] + '%.6f' % float(token[1:]))
+        for (id, tags, geoms) in routes:
+            start = time()
             
-            elif float_pat.match(token):
-                # in python 2.6, we see a simple float literal
-                output.write('%.6f' % float(token))
+            try:
+                geometry = merge_route(map(decoded_geometry, geoms), dedupe)
+            except Exception, e:
+                logging.error('Route %s: %s' % (id, e))
+                continue
             
-            else:
-                output.write(token)        
-
+            logging.debug('Route %s: merged %d ways in %.3f seconds' % (id, len(geoms), time() - start))
+            
+            if geometry:
+                features.append(dict(type='Feature', id=id, properties=tags, geometry=geometry.__geo_interface__))
+        
+        output = CompressedOutput('routes-%06d.json.bz2' % index)
+        write_feature_collection(output, features, '%.6f')
         output.close()
+        digest = output.hexdigest()
     
     except Exception, e:
-        return index, len(routes), e
+        if output is not None and output.thread.is_alive():
+            output.close()
+        
+        return index, routes_count, e, digest
     
-    return index, len(routes), True
+    return index, routes_count, True, digest
 
 optparser = OptionParser(usage="""%prog [options] <database>""")
 
-defaults = dict(host='localhost', user='osm2pgsql', passwd=None, table_prefix='planet_osm', count=5000, loglevel=logging.INFO)
+defaults = dict(host='localhost', user='osm2pgsql', passwd=None, table_prefix='planet_osm', count=5000, jobs=6, in_flight=12, transport='shapely', bbox=None, mask_file=None, batch_size=10000, way_cache=256, target_vertices=100000, dedupe=False, route_table=None, refresh_route_table=False, manifest=None, previous_manifest=None, chunk_prefix='', fingerprint=None, loglevel=logging.INFO)
 
 optparser.set_defaults(**defaults)
 
@@ -233,6 +527,51 @@ optparser.add_option('-p', '--passwd', dest='passwd',
 optparser.add_option('-t', '--table-prefix', dest='table_prefix',
                      help='Osm2psql table name prefix, default "%(table_prefix)s".' % defaults)
 
+optparser.add_option('-b', '--bbox', dest='bbox',
+                     help='Only extract route ways in this "west,south,east,north" box, in degrees.')
+
+optparser.add_option('-m', '--mask-file', dest='mask_file',
+                     help='Only extract route ways in the polygons of this GeoJSON or WKT file, in degrees.')
+
+optparser.add_option('--route-table', dest='route_table',
+                     help='Read filtered route relations from this table instead of scanning all of the rels table.')
+
+optparser.add_option('--refresh-route-table', dest='refresh_route_table', action='store_true',
+                     help='Create or refill the --route-table table from the rels table before extracting.')
+
+optparser.add_option('--batch-size', dest='batch_size', type='int',
+                     help='Most relation or way IDs to look up per query, default %(batch_size)d.' % defaults)
+
+optparser.add_option('--way-cache', dest='way_cache', type='int',
+                     help='Megabytes of way geometries to keep for reuse between relations, default %(way_cache)d.' % defaults)
+
+optparser.add_option('--target-vertices', dest='target_vertices', type='int',
+                     help='Vertices per route group, with bigger routes split into several features, default %(target_vertices)d.' % defaults)
+
+optparser.add_option('--dedupe', dest='dedupe', action='store_true',
+                     help='Drop repeated copies of identical way lines before merging each route.')
+
+optparser.add_option('-j', '--jobs', dest='jobs', type='int',
+                     help='Number of encoding processes, default %(jobs)d.' % defaults)
+
+optparser.add_option('-f', '--in-flight', dest='in_flight', type='int',
+                     help='Most route groups fetched but not yet written, default %(in_flight)d.' % defaults)
+
+optparser.add_option('--transport', dest='transport', type='choice', choices=('shapely', 'wkb', 'file'),
+                     help='How route groups get to the encoding processes: pickled "shapely" geometries, raw "wkb" buffers decoded by the encoders, or "file" to spool WKB to shared memory and send just the file name. Default "%(transport)s".' % defaults)
+
+optparser.add_option('--manifest', dest='manifest',
+                     help='Write a manifest of chunk digests and locations to this file.')
+
+optparser.add_option('--previous-manifest', dest='previous_manifest',
+                     help='Manifest from an earlier run. Route groups are cut where they were cut then, and chunks that come out the same are removed and listed by their old location in the new manifest.')
+
+optparser.add_option('--chunk-prefix', dest='chunk_prefix',
+                     help='Where the chunks from this run will be uploaded, recorded as their location in the manifest, e.g. "2013-01-01-routes/routes-geojson/".')
+
+optparser.add_option('--fingerprint', dest='fingerprint',
+                     help='Anything that identifies how chunks will be processed, e.g. a hash of the processing scripts, recorded in the manifest. No chunks are carried forward from a previous manifest with a different fingerprint.')
+
 optparser.add_option('-v', '--verbose', dest='loglevel',
                      action='store_const', const=logging.DEBUG,
                      help='Output extra progress information.')
@@ -245,28 +584,73 @@ if __name__ == '__main__':
 
     opts, (dbname, ) = optparser.parse_args()
     
+    if opts.refresh_route_table and not opts.route_table:
+        optparser.error('--refresh-route-table needs a --route-table name.')
+    
+    if opts.previous_manifest and not opts.manifest:
+        optparser.error('--previous-manifest needs a --manifest to write.')
+    
     logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
     
     db = connect(host=opts.host, database=dbname, user=opts.user, password=opts.passwd)
     db = db.cursor()
     
+    if opts.refresh_route_table:
+        refresh_route_table(db, opts)
+    
+    if opts.bbox or opts.mask_file:
+        build_masks(db, opts)
+    
     #
     # Build temporary table with relation IDs
     #
     relations = get_relations_list(db, opts)
-    route_groups = gen_relation_groups(db, opts, relations)
-    pool = Pool(6)
+    previous, fingerprint = load_manifest(opts.previous_manifest)
+    boundaries = set([tuple([value.encode('utf8') for value in chunk['first']])
+                      for chunk in previous.values() if chunk.get('first')])
+    
+    if previous and fingerprint != opts.fingerprint:
+        # cut in the same places, but outputs from before can't be reused
+        logging.info('Processing fingerprint has changed, carrying no chunks forward')
+        previous = dict()
+    
+    route_groups = gen_relation_groups(db, opts, relations, boundaries)
+    pool = Pool(opts.jobs)
+    chunks = dict()
+    
+    #
+    # Each group takes a slot before it's fetched and gives it back once
+    # written, so the database can't get more than opts.in_flight groups
+    # ahead of the encoders and memory stays flat.
+    #
+    in_flight = BoundedSemaphore(opts.in_flight)
+    
+    def callback((index, count, status, digest)):
+        in_flight.release()
+        
+        if status is True:
+            logging.info('%(index)d. Wrote %(count)d routes' % locals())
+            chunks['routes-%06d.json.bz2' % index].update(digest=digest, count=count)
+        else:
+            logging.info('%(index)d. Failed: %(status)s' % locals())
+            del chunks['routes-%06d.json.bz2' % index]
+    
+    in_flight.acquire()
     
     for (routes, index) in izip(route_groups, count(1)):
+        # the group's first key, for cutting in the same place next time
+        first = routes and relation_key(routes[0][:2]) or None
+        chunks['routes-%06d.json.bz2' % index] = dict(first=first)
         
-        def callback((index, count, status)):
-            if status is True:
-                logging.info('%(index)d. Wrote %(count)d routes' % locals())
-            else:
-                logging.info('%(index)d. Failed: %(status)s' % locals())
+        if opts.transport == 'file':
+            routes = spool_records(routes)
         
-        pool.apply_async(output_geojson_bzipped, (index, routes), callback=callback)
+        pool.apply_async(output_geojson_bzipped, (index, routes, opts.dedupe), callback=callback)
+        in_flight.acquire()
         
     db.close()
     pool.close()
     pool.join()
+    
+    if opts.manifest:
+        update_manifest(opts.manifest, previous, chunks, opts.chunk_prefix, opts.fingerprint)
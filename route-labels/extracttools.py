@@ -0,0 +1,169 @@
+''' Functions shared by the extract and download scripts for routes and streets.
+
+Region masks from --bbox or --mask-file, see build_masks(). Spool files
+for the "file" transport, see spool_records(). Chunk manifests: an
+extract writes its chunks' digests and locations, see
+update_manifest(). The next extract carries unchanged chunks forward by
+their old location, and the download script finds their outputs there.
+'''
+from json import loads as loads_json, load as load_json, dump as dump_json
+from os.path import exists, basename, dirname, isdir
+from os import fdopen, remove, rename
+from tempfile import mkstemp
+
+import marshal
+import logging
+
+from shapely.geometry import asShape
+
+def mask_geometries(opts):
+    '''
+    '''
+    if opts.bbox:
+        xmin, ymin, xmax, ymax = map(float, opts.bbox.split(','))
+        return ['POLYGON((%(xmin).8f %(ymin).8f, %(xmax).8f %(ymin).8f, %(xmax).8f %(ymax).8f, %(xmin).8f %(ymax).8f, %(xmin).8f %(ymin).8f))' % locals()]
+    
+    content = open(opts.mask_file).read()
+    
+    try:
+        geojson = loads_json(content)
+    except ValueError:
+        # not GeoJSON, so hopefully well-known text
+        return [content.strip()]
+    
+    features = geojson.get('features', [geojson])
+    geometries = [feature.get('geometry', feature) for feature in features]
+    
+    return [asShape(geometry).wkt for geometry in geometries]
+
+def build_masks(db, opts):
+    '''
+    '''
+    db.execute('CREATE TEMPORARY TABLE masks (way GEOMETRY)')
+    
+    for wkt in mask_geometries(opts):
+        db.execute('''INSERT INTO masks
+                      SELECT (Dump(Transform(SetSrid(GeomFromText(%s), 4326), 900913))).geom''', (wkt, ))
+    
+    db.execute('CREATE INDEX masks_way ON masks USING GIST (way)')
+    db.execute('ANALYZE masks')
+
+def spool_records(records):
+    '''
+    '''
+    #
+    # /dev/shm is shared memory on Linux, so the spool file never touches
+    # the disk there. Only its name goes through the pool's task queue.
+    #
+    handle, filename = mkstemp(dir=(isdir('/dev/shm') and '/dev/shm' or None), prefix='spool-', suffix='.marshal')
+    file = fdopen(handle, 'wb')
+    
+    for record in records:
+        marshal.dump(record, file)
+    
+    file.close()
+    
+    return filename
+
+def unspool_records(filename):
+    '''
+    '''
+    file = open(filename, 'rb')
+    
+    try:
+        while True:
+            try:
+                yield marshal.load(file)
+            except EOFError:
+                break
+    
+    finally:
+        file.close()
+        remove(filename)
+
+def load_manifest(filename):
+    ''' Chunks from a previous run's manifest keyed by content digest, and its fingerprint.
+        
+        Returns an empty dictionary and None if there's no such file yet.
+    '''
+    if not filename or not exists(filename):
+        return dict(), None
+    
+    manifest = load_json(open(filename))
+    chunks = manifest['chunks']
+    
+    return dict([(chunk['digest'], chunk) for chunk in chunks.values()]), manifest.get('fingerprint')
+
+def update_manifest(filename, previous, chunks, chunk_prefix, fingerprint):
+    ''' Write a manifest for this run, and remove chunk files that haven't changed.
+        
+        chunks maps each new chunk file name to a dictionary with its
+        digest. A chunk with the same digest as one from the previous
+        run is carried forward: it keeps the old chunk's location, and
+        its new file is removed so that only changed chunks get uploaded.
+    '''
+    manifest, changed = dict(), 0
+    
+    for (name, chunk) in sorted(chunks.items()):
+        if chunk['digest'] in previous:
+            chunk['location'] = previous[chunk['digest']]['location']
+            remove(name)
+        
+        else:
+            chunk['location'] = chunk_prefix + name
+            changed += 1
+        
+        manifest[name] = chunk
+    
+    # write beside and rename over, so a failed run leaves no half a manifest
+    with open(filename + '.tmp', 'w') as file:
+        dump_json(dict(chunks=manifest, fingerprint=fingerprint), file, indent=2, sort_keys=True)
+    
+    rename(filename + '.tmp', filename)
+    
+    logging.info('%d of %d chunks changed since the previous manifest' % (changed, len(manifest)))
+
+def carried_outputs(s3, filename, aws_prefix):
+    ''' List (key, name) pairs for outputs of chunks carried forward from earlier runs.
+        
+        filename is a manifest from an extract script, whose unchanged
+        chunks point at the run where they were last uploaded. Their
+        outputs are in that run's output directory, and each is named
+        here after the chunk in this run so table names don't collide.
+        
+        Logs each carried chunk that has no outputs and raises an error,
+        instead of leaving their features out of the download unnoticed.
+    '''
+    run_directory = dirname(aws_prefix.rstrip('/'))
+    chunks = load_json(open(filename))['chunks']
+    outputs, carried, missing = dict(), [], []
+    
+    for (name, chunk) in sorted(chunks.items()):
+        location = chunk['location']
+        directory = dirname(dirname(location))
+        
+        if directory == run_directory:
+            # changed this time, so its outputs are under aws_prefix
+            continue
+        
+        if directory not in outputs:
+            # every output from that run, by chunk name, e.g. "12-routes-000001.json.bz2"
+            outputs[directory] = dict()
+            
+            for key in s3.list('%s/output/' % directory):
+                zoom, chunk_name = basename(key.name).split('-', 1)
+                outputs[directory].setdefault(chunk_name, []).append((zoom, key))
+        
+        chunk_outputs = outputs[directory].get(basename(location), [])
+        
+        if not chunk_outputs:
+            logging.error('No outputs for %s, carried forward from %s' % (name, location))
+            missing.append(name)
+        
+        for (zoom, key) in chunk_outputs:
+            carried.append((key, '%s-%s' % (zoom, name)))
+    
+    if missing:
+        raise RuntimeError('%d carried-forward chunks have no outputs' % len(missing))
+    
+    return carried
@@ -0,0 +1,253 @@
+''' Fixed-precision GeoJSON output for the extract and process scripts.
+
+Produces the same bytes as running JSONEncoder(separators=(',', ':'))
+and reformatting every float token with float_pat/charfloat_pat, without
+the per-token regular expressions. Coordinate arrays are formatted a
+whole line at a time, which is where nearly all of the time used to go.
+'''
+from json.encoder import encode_basestring_ascii
+from itertools import chain
+from hashlib import sha1
+from threading import Thread
+from Queue import Queue
+from bz2 import BZ2File
+
+INFINITY = float('inf')
+
+def _floatstr(value, format):
+    '''
+    '''
+    # repr() is plain d.ddd in this range, which float_pat always matched
+    if 1e-4 <= abs(value) < 1e16 or value == 0:
+        return format % value
+
+    if value != value:
+        return 'NaN'
+
+    elif value == INFINITY:
+        return 'Infinity'
+
+    elif value == -INFINITY:
+        return '-Infinity'
+
+    text = repr(value)
+
+    # float_pat needs a decimal point and no positive exponent, so
+    # e.g. "1e-05" or "1.5e+16" used to pass through unformatted.
+    if '.' in text and 'e+' not in text:
+        return format % value
+
+    return text
+
+def _is_finite(value):
+    '''
+    '''
+    return value - value == 0
+
+def _keystr(key):
+    '''
+    '''
+    if isinstance(key, basestring):
+        return encode_basestring_ascii(key)
+
+    elif isinstance(key, float):
+        # float keys were quoted, so float_pat never saw them
+        return encode_basestring_ascii(_floatstr(key, '%r'))
+
+    elif key is True:
+        return '"true"'
+
+    elif key is False:
+        return '"false"'
+
+    elif key is None:
+        return '"null"'
+
+    elif isinstance(key, (int, long)):
+        return '"%d"' % key
+
+    raise TypeError('key %s is not a string' % repr(key))
+
+def _encode_positions(positions, format):
+    '''
+    '''
+    values = list(chain.from_iterable(positions))
+    dimensions = set(map(len, positions))
+
+    if values and len(dimensions) == 1 and set(map(type, values)) == set([float]) \
+    and _is_finite(sum(values)) and min(map(abs, values)) >= 1e-4 and max(map(abs, values)) < 1e16:
+        #
+        # Every value is an ordinary float, so each position
+        # can be formatted with a single string operation.
+        # The sum is NaN or infinite if any one value is.
+        #
+        template = '[%s]' % ','.join([format] * dimensions.pop())
+        return '[%s]' % ','.join([template % tuple(position) for position in positions])
+
+    return '[%s]' % ','.join([encode(position, format) for position in positions])
+
+def _encode_coordinates(coordinates, format):
+    '''
+    '''
+    if not coordinates or isinstance(coordinates[0], (int, long, float)):
+        # empty, or a single position
+        return encode(coordinates, format)
+
+    first = coordinates[0]
+
+    if isinstance(first, (list, tuple)) and first and isinstance(first[0], (int, long, float)):
+        # a list of positions, e.g. a linestring or a ring
+        return _encode_positions(coordinates, format)
+
+    return '[%s]' % ','.join([_encode_coordinates(part, format) for part in coordinates])
+
+def encode(obj, format='%.6f'):
+    ''' Encode obj to a compact JSON string, with floats at fixed precision.
+    '''
+    if isinstance(obj, basestring):
+        return encode_basestring_ascii(obj)
+
+    elif obj is None:
+        return 'null'
+
+    elif obj is True:
+        return 'true'
+
+    elif obj is False:
+        return 'false'
+
+    elif isinstance(obj, (int, long)):
+        return str(obj)
+
+    elif isinstance(obj, float):
+        return _floatstr(obj, format)
+
+    elif isinstance(obj, dict):
+        items = []
+
+        for (key, value) in obj.iteritems():
+            if key == 'coordinates' and isinstance(value, (list, tuple)):
+                items.append(_keystr(key) + ':' + _encode_coordinates(value, format))
+            else:
+                items.append(_keystr(key) + ':' + encode(value, format))
+
+        return '{%s}' % ','.join(items)
+
+    elif isinstance(obj, (list, tuple)):
+        return '[%s]' % ','.join([encode(value, format) for value in obj])
+
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+def dump(obj, output, format='%.6f'):
+    ''' Write obj to a file-like output, one dictionary item or list member at a time.
+    '''
+    if isinstance(obj, dict):
+        output.write('{')
+
+        for (index, (key, value)) in enumerate(obj.iteritems()):
+            output.write((index and ',' or '') + _keystr(key) + ':')
+
+            if key == 'coordinates' and isinstance(value, (list, tuple)):
+                output.write(_encode_coordinates(value, format))
+            else:
+                dump(value, output, format)
+
+        output.write('}')
+
+    elif isinstance(obj, (list, tuple)):
+        output.write('[')
+
+        for (index, value) in enumerate(obj):
+            if index:
+                output.write(',')
+
+            dump(value, output, format)
+
+        output.write(']')
+
+    else:
+        output.write(encode(obj, format))
+
+def write_feature_collection(output, features, format='%.6f'):
+    ''' Write a FeatureCollection from any iterable of features, return their count.
+
+        The opening matches how JSONEncoder orders dict(type=..., features=...).
+    '''
+    output.write('{"type":"FeatureCollection","features":[')
+    count = 0
+
+    for feature in features:
+        output.write((count and ',' or '') + encode(feature, format))
+        count += 1
+
+    output.write(']}')
+
+    return count
+
+class CompressedOutput (object):
+    ''' Bzip2 output file compressed in a background thread.
+
+        Writes are gathered into blocks and handed to the compressor through
+        a bounded queue, so encoding in the caller overlaps with compression.
+        The uncompressed content is hashed on the way, see hexdigest().
+    '''
+    def __init__(self, filename, blocks=8, blocksize=0x10000):
+        self.queue = Queue(blocks)
+        self.blocksize = blocksize
+        self.buffer, self.buffered = [], 0
+        self.errors = []
+        self.hash = sha1()
+
+        self.thread = Thread(target=self._compress, args=(filename, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.blocksize:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def hexdigest(self):
+        ''' SHA-1 of everything written so far, before compression.
+        '''
+        return self.hash.hexdigest()
+
+    def _flush(self):
+        if self.buffer:
+            block = ''.join(self.buffer)
+            self.hash.update(block)
+            self.queue.put(block)
+            self.buffer, self.buffered = [], 0
+
+    def _compress(self, filename):
+        output = None
+
+        try:
+            output = BZ2File(filename, 'w')
+
+            for block in iter(self.queue.get, None):
+                output.write(block)
+
+        except Exception, e:
+            self.errors.append(e)
+
+            # keep draining so that writers never block
+            for block in iter(self.queue.get, None):
+                pass
+
+        finally:
+            if output is not None:
+                try:
+                    output.close()
+                except Exception, e:
+                    self.errors.append(e)
@@ -74,8 +74,10 @@ BOTO
 
 curl -sOL http://169.254.169.254/latest/meta-data/instance-id
 curl -sOL http://s3.amazonaws.com/%(bucket)s/%(directory)s/process-routes.py
+curl -sOL http://s3.amazonaws.com/%(bucket)s/%(directory)s/geojsonwriter.py
+curl -sOL http://s3.amazonaws.com/%(bucket)s/%(directory)s/leases.py
 
-python process-routes.py %(bucket)s %(prefix)s 12 13 14 15
+python process-routes.py --multi-zoom --log-prefix task-logs/routes %(bucket)s %(prefix)s 12 13 14 15
 
 python <<KILL
 
@@ -0,0 +1,286 @@
+''' Expiring claims on named pieces of work, shared between workers.
+
+A worker claims a name before starting on it and keeps renewing the claim
+while it works. Other workers skip names with a live claim, and can take
+over a claim once its holder has stopped renewing it and it has expired.
+
+DirectoryLeases keeps claims as files in a local directory, and S3Leases
+keeps them as keys in a bucket. Both have the same claim(), renew() and
+release() methods, so a Renewal works the same way with either one.
+'''
+from os import open as os_open, close, link, rename, remove, getpid, O_CREAT, O_EXCL, O_WRONLY
+from os.path import join, exists, getmtime
+from threading import Thread, Event
+from socket import gethostname
+from urllib import quote
+from uuid import uuid4
+from time import time, sleep
+
+import errno
+import json
+
+def _new_owner():
+    '''
+    '''
+    return '%s-%d-%s' % (gethostname(), getpid(), uuid4().hex[:8])
+
+def _lease_content(owner, duration):
+    '''
+    '''
+    return json.dumps(dict(owner=owner, expires=time() + duration))
+
+def _live_owner(content):
+    ''' Return the owner of a lease if it hasn't expired yet, or None.
+    '''
+    try:
+        lease = json.loads(content)
+    except ValueError:
+        # half-written, or not a lease at all
+        return None
+    
+    if lease.get('expires', 0) < time():
+        return None
+    
+    return lease.get('owner')
+
+class DirectoryLeases (object):
+    ''' Leases kept as files in a local directory.
+        
+        New leases are written beside and hard-linked into place, which
+        fails if the name already exists, so a lease appears whole or not
+        at all. Taking over an expired lease, renewing, and releasing
+        happen under a short-lived ".lock" file, so only one worker can
+        ever win a name. A lock left behind by a worker that died while
+        holding it is broken after a lease duration.
+    '''
+    def __init__(self, path, duration=600):
+        self.path = path
+        self.duration = duration
+        self.owner = _new_owner()
+    
+    def claim(self, name):
+        ''' Return True if the name is now ours, False if someone else holds it.
+        '''
+        filename = self._filename(name)
+        
+        for attempt in range(2):
+            if self._create(filename):
+                return True
+            
+            owner = _live_owner(self._read(filename))
+            
+            if owner == self.owner:
+                return True
+            
+            if owner is not None or not self._lock(filename):
+                return False
+            
+            try:
+                #
+                # Someone may have taken it over between the read above
+                # and the lock, so only remove it if it's still expired.
+                #
+                if exists(filename) and _live_owner(self._read(filename)) is None:
+                    remove(filename)
+            
+            finally:
+                self._unlock(filename)
+        
+        return False
+    
+    def renew(self, name):
+        ''' Push back the expiry of a lease, return False if it's no longer ours.
+        '''
+        filename = self._filename(name)
+        
+        if not self._lock(filename):
+            raise RuntimeError('Timed out waiting to renew %s' % name)
+        
+        try:
+            if _live_owner(self._read(filename)) != self.owner:
+                return False
+            
+            # write beside and rename over, so readers never see half a lease
+            fresh = self._write_beside(filename)
+            rename(fresh, filename)
+        
+        finally:
+            self._unlock(filename)
+        
+        return True
+    
+    def release(self, name):
+        ''' Give up a lease if it's ours.
+        '''
+        filename = self._filename(name)
+        
+        if not self._lock(filename):
+            # it'll expire soon enough
+            return
+        
+        try:
+            if _live_owner(self._read(filename)) == self.owner:
+                remove(filename)
+        
+        finally:
+            self._unlock(filename)
+    
+    def _create(self, filename):
+        fresh = self._write_beside(filename)
+        
+        try:
+            link(fresh, filename)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        else:
+            return True
+        finally:
+            remove(fresh)
+    
+    def _write_beside(self, filename):
+        fresh = '%s.%s' % (filename, self.owner)
+        
+        with open(fresh, 'w') as file:
+            file.write(_lease_content(self.owner, self.duration))
+        
+        return fresh
+    
+    def _lock(self, filename, timeout=5):
+        lockname = filename + '.lock'
+        start = time()
+        
+        while True:
+            try:
+                close(os_open(lockname, O_CREAT | O_EXCL | O_WRONLY))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                return True
+            
+            try:
+                if time() - getmtime(lockname) > self.duration:
+                    remove(lockname)
+                    continue
+            except OSError:
+                # unlocked meanwhile
+                continue
+            
+            if time() - start > timeout:
+                return False
+            
+            sleep(.01)
+    
+    def _unlock(self, filename):
+        remove(filename + '.lock')
+    
+    def _filename(self, name):
+        return join(self.path, quote(name, safe='') + '.lease')
+    
+    def _read(self, filename):
+        if not exists(filename):
+            return ''
+        
+        try:
+            return open(filename).read()
+        except IOError:
+            # removed since the check
+            return ''
+
+class S3Leases (object):
+    ''' Leases kept as keys in an S3 bucket, named after the work with ".lease" added.
+        
+        S3 can't create a key only if it's missing, so a claim writes the
+        lease and reads it back after settle seconds. When two workers
+        race, the one whose write landed last keeps the claim.
+        
+        Any object with boto's get_key() and new_key() works as bucket,
+        as long as its keys have get_contents_as_string(),
+        set_contents_from_string() and delete().
+    '''
+    def __init__(self, bucket, duration=600, settle=5):
+        self.bucket = bucket
+        self.duration = duration
+        self.settle = settle
+        self.owner = _new_owner()
+    
+    def claim(self, name):
+        ''' Return True if the name is now ours, False if someone else holds it.
+        '''
+        owner = self._live_owner(name)
+        
+        if owner == self.owner:
+            return True
+        
+        if owner is not None:
+            return False
+        
+        self.bucket.new_key(name + '.lease').set_contents_from_string(_lease_content(self.owner, self.duration))
+        sleep(self.settle)
+        
+        return self._live_owner(name) == self.owner
+    
+    def renew(self, name):
+        ''' Push back the expiry of a lease, return False if it's no longer ours.
+        '''
+        if self._live_owner(name) != self.owner:
+            return False
+        
+        self.bucket.new_key(name + '.lease').set_contents_from_string(_lease_content(self.owner, self.duration))
+        
+        return True
+    
+    def release(self, name):
+        ''' Give up a lease if it's ours.
+        '''
+        key = self.bucket.get_key(name + '.lease')
+        
+        if key is not None and _live_owner(key.get_contents_as_string()) == self.owner:
+            key.delete()
+    
+    def _live_owner(self, name):
+        key = self.bucket.get_key(name + '.lease')
+        
+        if key is None:
+            return None
+        
+        return _live_owner(key.get_contents_as_string())
+
+class Renewal (object):
+    ''' Renew a claimed lease in a background thread until stopped.
+        
+        Renews at a third of the lease duration, and sets the lost event
+        if the lease turns out to belong to someone else.
+    '''
+    def __init__(self, leases, name):
+        self.leases = leases
+        self.name = name
+        self.lost = Event()
+        self.stopped = Event()
+        
+        self.thread = Thread(target=self._renew)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        ''' Stop renewing and release the lease.
+        '''
+        self.stopped.set()
+        self.thread.join()
+        
+        if not self.lost.is_set():
+            self.leases.release(self.name)
+    
+    def _renew(self):
+        while not self.stopped.wait(self.leases.duration / 3.):
+            try:
+                renewed = self.leases.renew(self.name)
+            except Exception:
+                # try again next time, the lease is still good for a while
+                continue
+            
+            if not renewed:
+                self.lost.set()
+                return
@@ -8,10 +8,19 @@ DIR=`date +%Y-%m-%d`-routes
 mkdir -p $DIR/routes-geojson
 mkdir -p $DIR/routes-geojson-100th
 
-python extract-routes.py -u osm2pgsql -p osm2pgsqlpassword osm2pgsql
+# a change to how chunks get processed means nothing can be carried forward
+FINGERPRINT=`cat process-routes.py geojsonwriter.py leases.py launch-routes.py | sha1sum | cut -d' ' -f1`
+
+# unchanged chunks are left out of $DIR and listed in its manifest instead,
+# see remote-run.sh for where routes-manifest.json comes from
+python extract-routes.py --previous-manifest routes-manifest.json \
+    --manifest $DIR/manifest.json --chunk-prefix $DIR/routes-geojson/ \
+    --fingerprint $FINGERPRINT -u osm2pgsql -p osm2pgsqlpassword osm2pgsql
 
 ln -f setup.sh $DIR/
 ln -f process-routes.py $DIR/
+ln -f geojsonwriter.py $DIR/
+ln -f leases.py $DIR/
 ln -f routes-*01.json.bz2 $DIR/routes-geojson-100th/
 mv routes-*.json.bz2 $DIR/routes-geojson/
 
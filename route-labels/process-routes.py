@@ -1,24 +1,162 @@
-from sys import argv
-from itertools import product
+from itertools import islice
+from optparse import OptionParser
 from multiprocessing import Pool
-from os import write, close, remove
+from os import write, close, remove, rename, listdir, getpid, sysconf
 from subprocess import Popen, PIPE
-from os.path import split, join, dirname
+from os.path import split, join, dirname, exists
 from StringIO import StringIO
+from socket import gethostname
 from tempfile import mkstemp
+from threading import Thread, Event, Condition
+from signal import signal, setitimer, SIGALRM, ITIMER_REAL
+from resource import getrlimit, setrlimit, RLIMIT_AS, RLIM_INFINITY
+from functools import partial
+from hashlib import sha1
 from random import shuffle
-from gzip import GzipFile
 from bz2 import BZ2File
-from re import compile
-from time import sleep
+from time import time
+from math import ceil, cos, radians
 
 import logging
 import json
+import re
 
 from boto import connect_s3
+from leases import DirectoryLeases, S3Leases, Renewal
+from geojsonwriter import CompressedOutput, write_feature_collection
 
-float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
-charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
+try:
+    #
+    # Imported once here and shared by every forked pool process,
+    # instead of once per skeletron-generalize.py subprocess.
+    #
+    from shapely.geometry import asShape
+    from shapely.wkb import loads as loads_wkb
+    from Skeletron.output import generalize_geometry
+except ImportError:
+    # only the subprocess path in publish_output() is available
+    generalize_geometry = None
+
+try:
+    # part of every SkeletonCache key, so an upgrade starts a fresh cache
+    from Skeletron import __version__ as skeletron_version
+except ImportError:
+    skeletron_version = 'unknown'
+
+features_pat = re.compile(r'"features"\s*:\s*\[')
+part_pat = re.compile(r'\.part-(\d+)-of-(\d+)$')
+
+class Superseded (Exception):
+    ''' Another worker took over the lease on this output.
+    '''
+    pass
+
+class FeatureTimeout (Exception):
+    ''' One feature took longer than its time budget.
+    '''
+    pass
+
+def process_rss(pid):
+    ''' Resident memory of a process in bytes, or zero if it's gone.
+    '''
+    try:
+        pages = int(open('/proc/%s/statm' % pid).read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return 0
+    
+    return pages * sysconf('SC_PAGE_SIZE')
+
+def process_vsize():
+    ''' Address space of this process in bytes, what RLIMIT_AS limits.
+    '''
+    pages = int(open('/proc/self/statm').read().split()[0])
+    
+    return pages * sysconf('SC_PAGE_SIZE')
+
+def child_pids(parent):
+    '''
+    '''
+    pids = []
+    
+    for pid in listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        
+        try:
+            # the parent pid is the second field after the parenthesized name
+            stat = open('/proc/%s/stat' % pid).read()
+            ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        except (IOError, ValueError):
+            continue
+        
+        if ppid == parent:
+            pids.append(pid)
+    
+    return pids
+
+class PeakMemory (object):
+    ''' Watch the resident memory of this process and its children in a background thread.
+        
+        The children are bzcat and skeletron-generalize.py when those run.
+        Python seldom gives memory back, so in a pool process that has run
+        other tasks before, the peak includes their high-water marks too.
+    '''
+    def __init__(self, interval=1.):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = Event()
+        
+        self.thread = Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        ''' Stop watching and return the highest total seen, in bytes.
+        '''
+        self.stopped.set()
+        self.thread.join()
+        
+        return self.peak
+    
+    def _sample(self):
+        pid = getpid()
+        
+        while True:
+            rss = process_rss(pid) + sum(map(process_rss, child_pids(pid)))
+            self.peak = max(self.peak, rss)
+            
+            if self.stopped.wait(self.interval):
+                return
+
+class MemoryBudget (object):
+    ''' Admit tasks only while their estimated memory fits in a limit.
+        
+        A task bigger than the whole limit is still admitted once
+        nothing else is running, so it can't wait forever.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = Condition()
+    
+    def admit(self, estimate):
+        ''' Block until estimate bytes fit, then count them as used.
+        '''
+        self.condition.acquire()
+        
+        while self.used and self.used + estimate > self.limit:
+            self.condition.wait(1)
+        
+        self.used += estimate
+        self.condition.release()
+    
+    def release(self, estimate):
+        '''
+        '''
+        self.condition.acquire()
+        self.used -= estimate
+        self.condition.notify_all()
+        self.condition.release()
 
 def download_input(input_key):
     '''
@@ -30,106 +168,662 @@ def download_input(input_key):
     
     return filename_input
 
-def generalize_input(filename_input, output_keyname, zoomlevel, pixelwidth):
+def decompress_input(filename_input):
+    ''' Decompress a downloaded input once, for generalize_input() to read at each zoom.
     '''
-    '''
-    handle, filename_thruput = mkstemp(dir='.', prefix='through-', suffix='.json.gz')
+    handle, filename_json = mkstemp(dir='.', prefix='input-', suffix='.json')
     close(handle)
     
+    file_json = open(filename_json, 'w')
+    bzcat = Popen(('bzcat', filename_input), stdout=file_json)
+    bzcat.wait()
+    file_json.close()
+    
+    if bzcat.returncode != 0:
+        raise Exception('bzcat %s exited with %d' % (filename_input, bzcat.returncode))
+    
+    return filename_json
+
+def stream_features(file, blocksize=0x10000):
+    ''' Generate the features of a GeoJSON FeatureCollection from a file, one at a time.
+        
+        Only the feature being decoded is held in memory, never the whole
+        collection. Raises ValueError if the collection is cut short.
+    '''
+    decoder, buffer = json.JSONDecoder(), ''
+    
+    while True:
+        match = features_pat.search(buffer)
+        
+        if match:
+            buffer = buffer[match.end():]
+            break
+        
+        block = file.read(blocksize)
+        
+        if not block:
+            raise ValueError('No features found')
+        
+        buffer += block
+    
+    while True:
+        buffer = buffer.lstrip(' \t\n\r,')
+        
+        if buffer.startswith(']'):
+            return
+        
+        try:
+            feature, end = decoder.raw_decode(buffer)
+        
+        except ValueError:
+            #
+            # Probably a partial feature. Read at least as much again as
+            # is already buffered, so a big feature isn't decoded from
+            # the start over and over for each new block.
+            #
+            block = file.read(max(blocksize, len(buffer)))
+            
+            if not block:
+                raise
+            
+            buffer += block
+            continue
+        
+        yield feature
+        buffer = buffer[end:]
+
+def modify_features(features, zoomlevel, pixelwidth):
+    '''
+    '''
+    for feature in features:
+        feature['properties']['zoomlevel'] = zoomlevel
+        feature['properties']['pixelwidth'] = pixelwidth
+        
+        yield feature
+
+def generalize_input(renewal, filename_input, filename_output, output_keyname, zoomlevel, pixelwidth):
+    ''' Run skeletron-generalize.py on a .json.bz2 or already-decompressed .json input.
+        
+        Features are streamed from its output straight into the compressed
+        filename_output. Returns a feature count and stderr file name,
+        with a count of None if another worker took over the lease.
+    '''
     handle, filename_stderr = mkstemp(dir='.', prefix='stderr-', suffix='.txt')
     close(handle)
     
-    file_thruput = open(filename_thruput, 'w')
     file_stderr = open(filename_stderr, 'w')
 
-    bzcat = Popen(('bzcat', filename_input), stdout=PIPE)
-    generalize = 'skeletron-generalize.py -q -z %d -w %d /dev/stdin /dev/stdout' % (zoomlevel, pixelwidth)
-    generalize = Popen(generalize.split(), stdin=bzcat.stdout, stdout=PIPE, stderr=file_stderr)
-    gzip = Popen('gzip -c'.split(), stdin=generalize.stdout, stdout=file_thruput)
+    if filename_input.endswith('.bz2'):
+        bzcat = Popen(('bzcat', filename_input), stdout=PIPE)
+        source, stdin = '/dev/stdin', bzcat.stdout
+    else:
+        bzcat, source, stdin = None, filename_input, None
     
-    while True:
-        polled = generalize.poll()
+    generalize = 'skeletron-generalize.py -q -z %d -w %d %s /dev/stdout' % (zoomlevel, pixelwidth, source)
+    generalize = Popen(generalize.split(), stdin=stdin, stdout=PIPE, stderr=file_stderr)
+    
+    #
+    # Kill the processes if the lease is lost while features stream
+    # through. That cuts the stream short and the ValueError from
+    # stream_features() is expected.
+    #
+    finished, killed = Event(), []
+    
+    def watch():
+        while not finished.wait(1):
+            if renewal.lost.is_set():
+                logging.info('Killing %s' % output_keyname)
+                killed.append(True)
+                
+                for process in filter(None, (bzcat, generalize)):
+                    process.kill()
+                
+                return
+    
+    watcher = Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+    
+    output = CompressedOutput(filename_output)
+    count = None
+    
+    try:
+        features = modify_features(stream_features(generalize.stdout), zoomlevel, pixelwidth)
+        count = write_feature_collection(output, features, '%.5f')
+    
+    except ValueError:
+        if not killed:
+            raise
+    
+    finally:
+        finished.set()
+        watcher.join()
+        output.close()
         
-        if polled is not None:
-            # looks like we are done?
-            break
+        # closed first so that an early error can't leave generalize blocked
+        generalize.stdout.close()
         
-        if s3.get_key(output_keyname) is not None:
-            # the output now exists, kill and back out
-            logging.info('Killing %s' % output_keyname)
+        if bzcat:
+            bzcat.wait()
+        
+        generalize.wait()
+        file_stderr.close()
+    
+    if killed:
+        return None, filename_stderr
+    
+    return count, filename_stderr
 
-            bzcat.kill()
-            generalize.kill()
-            gzip.kill()
-            
-            file_thruput.close()
-            file_stderr.close()
+def publish_output(s3, renewal, filename_input, output_keyname, zoomlevel, pixelwidth, garbage):
+    ''' Generalize one input file at one zoom and upload the result.
+        
+        Returns False if another worker got there first. Temporary
+        files are added to the garbage set for the caller to remove.
+    '''
+    handle, filename_output = mkstemp(dir='.', prefix='output-', suffix='.json.bz2')
+    close(handle)
+    
+    garbage.add(filename_output)
+    count, filename_stderr = generalize_input(renewal, filename_input, filename_output, output_keyname, zoomlevel, pixelwidth)
+    garbage.add(filename_stderr)
+    
+    if count is None:
+        # Probably killed?
+        return False
+    
+    stderr_key = s3.new_key(output_keyname + '.stderr')
+    stderr_key.set_contents_from_filename(filename_stderr, policy='public-read')
+    
+    logging.info('Generalized %d features for %s' % (count, output_keyname))
+    
+    output_key = s3.new_key(output_keyname)
+    output_key.set_contents_from_filename(filename_output, policy='public-read')
+    
+    return True
 
-            remove(filename_thruput)
-            return None, filename_stderr
+def load_features(filename_input, part=None):
+    ''' Parse a downloaded input into (id, properties, shape) tuples for generalize_features().
+        
+        With part, an (index, count) tuple, only that share of the features is kept.
+    '''
+    if part:
+        # stream the input so only this part's features are ever held
+        index, count = part
+        features = islice(stream_features(BZ2File(filename_input)), index, None, count)
+    else:
+        features = json.load(BZ2File(filename_input))['features']
+    
+    return [(feature.get('id', None), feature.get('properties', {}), asShape(feature['geometry']))
+            for feature in features]
 
-        sleep(15)
+def extract_part(filename_input, part):
+    ''' Write one share of a downloaded input's features to a plain .json file.
+        
+        Part is an (index, count) tuple. Features are dealt out in turn,
+        so a run of slow features in the input is spread between parts.
+    '''
+    index, count = part
     
-    bzcat.wait()
-    generalize.wait()
-    gzip.wait()
+    handle, filename_part = mkstemp(dir='.', prefix='input-', suffix='.json')
+    close(handle)
     
-    file_thruput.close()
-    file_stderr.close()
+    output = open(filename_part, 'w')
+    features = stream_features(BZ2File(filename_input))
+    write_feature_collection(output, islice(features, index, None, count), '%.6f')
+    output.close()
+    
+    return filename_part
 
-    return filename_thruput, filename_stderr
+def budgeted(function, args, seconds, megabytes):
+    ''' Call function(*args) with at most this many seconds and megabytes of new memory.
+        
+        Raises FeatureTimeout or MemoryError when a budget runs out. The
+        time limit only works in a process's main thread, where pool
+        tasks run, and only interrupts Python code, not a long C call.
+        
+        The memory limit is an address space limit on the whole process,
+        so it also covers other threads running meanwhile, like output
+        compression, lease renewal, and PeakMemory sampling.
+    '''
+    soft, hard = getrlimit(RLIMIT_AS)
+    
+    if megabytes:
+        limit = process_vsize() + megabytes * 1048576
+        
+        if hard != RLIM_INFINITY:
+            limit = min(limit, hard)
+        
+        setrlimit(RLIMIT_AS, (limit, hard))
+    
+    running = [True]
+    
+    def raise_timeout(signum, frame):
+        # an alarm arriving after the call has returned is too late to matter
+        if running[0]:
+            raise FeatureTimeout()
+    
+    previous = signal(SIGALRM, raise_timeout)
+    
+    if seconds:
+        setitimer(ITIMER_REAL, seconds)
+    
+    try:
+        try:
+            return function(*args)
+        finally:
+            running[0] = False
+    
+    finally:
+        # always put everything back, even after a late FeatureTimeout
+        setitimer(ITIMER_REAL, 0)
+        signal(SIGALRM, previous)
+        setrlimit(RLIMIT_AS, (soft, hard))
+
+def pixel_degrees(zoomlevel):
+    ''' Width of one 256-pixel-tile pixel at the equator, in degrees.
+    '''
+    return 360. / (256 * 2**zoomlevel)
 
-def modify_throughput(filename_thruput, zoomlevel, pixelwidth):
+def count_vertices(shape):
     '''
     '''
-    geojson = json.load(GzipFile(filename_thruput))
+    if hasattr(shape, 'geoms'):
+        return sum([count_vertices(part) for part in shape.geoms])
     
-    for feature in geojson['features']:
-        feature['properties']['zoomlevel'] = zoomlevel
-        feature['properties']['pixelwidth'] = pixelwidth
+    elif hasattr(shape, 'exterior'):
+        return sum([len(ring.coords) for ring in [shape.exterior] + list(shape.interiors)])
     
-    return geojson
+    return len(shape.coords)
 
-def encode_output(geojson):
+class Presimplifier (object):
+    ''' Simplify geometries to a fraction of a pixel before they're generalized.
+        
+        Skeletron can't show detail finer than a pixel at the zoom it's
+        working at, so it may as well never see it. Vertex counts before
+        and after are kept for logging, see publish_generalized().
     '''
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.before, self.after = 0, 0
+    
+    def simplify(self, shape, zoomlevel):
+        ''' Return a simplified shape, or the shape itself if that comes out empty.
+        '''
+        #
+        # A pixel covers fewer degrees of latitude than of longitude,
+        # by the cosine of the latitude in spherical mercator, so use
+        # the latitude farthest from the equator to stay under a pixel.
+        #
+        xmin, ymin, xmax, ymax = shape.bounds
+        latitude = min(max(abs(ymin), abs(ymax)), 85.)
+        tolerance = self.pixels * pixel_degrees(zoomlevel) * cos(radians(latitude))
+        
+        simple = shape.simplify(tolerance, False)
+        
+        if simple.is_empty:
+            simple = shape
+        
+        self.before += count_vertices(shape)
+        self.after += count_vertices(simple)
+        
+        return simple
+
+class Quarantine (object):
+    ''' Features that ran out of budget, one small JSON record per geometry hash.
+        
+        Records are kept in a local directory if one is given, or else
+        as keys under a fixed prefix in S3, so every worker in this run
+        and later ones sees them.
     '''
-    handle, filename_output = mkstemp(dir='.', prefix='output-', suffix='.json.bz2')
-    close(handle)
+    def __init__(self, s3, prefix, directory=None):
+        self.s3 = s3
+        self.prefix = prefix
+        self.directory = directory
     
-    encoder = json.JSONEncoder(separators=(',', ':'))
-    encoded = encoder.iterencode(geojson)
-    format = '%.5f'
+    def hashes(self):
+        ''' Return the set of quarantined geometry hashes.
+        '''
+        if self.directory:
+            names = exists(self.directory) and listdir(self.directory) or []
+        else:
+            names = [key.name for key in self.s3.list(prefix=self.prefix + '/')]
+        
+        return set([split(name)[1][:-5] for name in names if name.endswith('.json')])
     
-    output = BZ2File(filename_output, 'w')
+    def add(self, hash, id, output_keyname, zoomlevel, reason):
+        '''
+        '''
+        record = json.dumps(dict(hash=hash, id=id, output=output_keyname, zoomlevel=zoomlevel, reason=reason))
+        
+        if self.directory:
+            file = open(join(self.directory, hash + '.json'), 'w')
+            file.write(record)
+            file.close()
+        else:
+            self.s3.new_key(join(self.prefix, hash + '.json')).set_contents_from_string(record)
 
-    for token in encoded:
-        if charfloat_pat.match(token):
-            # in python 2.7, we see a character followed by a float literal
-            output.write(token[0] + format % float(token[1:]))
+class FeatureLimits (object):
+    ''' Per-feature time and memory budgets for generalize_features().
+        
+        A feature that runs out of budget is skipped and quarantined by
+        the SHA-1 of its WKB geometry. Quarantined features are skipped
+        up front later on, or with fallback "simplify" are simplified to
+        a pixel and given one more try.
+    '''
+    def __init__(self, s3, seconds, megabytes, quarantine_prefix, quarantine_dir, fallback):
+        self.quarantine = Quarantine(s3, quarantine_prefix, quarantine_dir)
+        self.quarantined = self.quarantine.hashes()
+        self.seconds = seconds
+        self.megabytes = megabytes
+        self.fallback = fallback
+    
+    def generalize(self, id, hash, shape, output_keyname, zoomlevel, pixelwidth):
+        ''' Return a generalized geometry, or None for a skipped feature.
+            
+            Hash is the SHA-1 of the feature's WKB geometry.
+        '''
+        if hash in self.quarantined:
+            if self.fallback == 'skip':
+                logging.info('%s: skipping quarantined feature %s' % (output_keyname, id))
+                return None
             
-        elif float_pat.match(token):
-            # in python 2.6, we see a simple float literal
-            output.write(format % float(token))
+            logging.info('%s: simplifying quarantined feature %s' % (output_keyname, id))
+            shape = shape.simplify(pixel_degrees(zoomlevel), False)
+        
+        try:
+            return budgeted(generalize_geometry, (shape, pixelwidth, zoomlevel), self.seconds, self.megabytes)
+        
+        except (FeatureTimeout, MemoryError), e:
+            reason = isinstance(e, FeatureTimeout) and 'time' or 'memory'
+            logging.warning('%s: feature %s ran out of %s' % (output_keyname, id, reason))
+            
+            if hash not in self.quarantined:
+                self.quarantine.add(hash, id, output_keyname, zoomlevel, reason)
+                self.quarantined.add(hash)
             
+            return None
+
+class SkeletonCache (object):
+    ''' Generalized geometries from earlier runs, by input geometry hash, zoom and pixel width.
+        
+        Skeletons are kept as WKB files in a local directory if one is
+        given, or else as keys under a prefix in S3. Skeletron's output
+        only depends on those three things and its own version, which is
+        part of each key, so a route whose geometry hasn't changed since
+        an earlier run with the same Skeletron is a lookup away.
+    '''
+    def __init__(self, s3, prefix, directory=None):
+        self.s3 = s3
+        self.prefix = prefix
+        self.directory = directory
+        self.hits, self.misses = 0, 0
+    
+    def get(self, hash, zoomlevel, pixelwidth):
+        ''' Return a cached geometry, or None.
+        '''
+        name = self._name(hash, zoomlevel, pixelwidth)
+        
+        if self.directory:
+            filename = join(self.directory, name)
+            data = exists(filename) and open(filename, 'rb').read() or None
+        else:
+            key = self.s3.get_key(join(self.prefix, name))
+            data = key and key.get_contents_as_string() or None
+        
+        if data is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return loads_wkb(data)
+    
+    def put(self, hash, zoomlevel, pixelwidth, skeleton):
+        '''
+        '''
+        name = self._name(hash, zoomlevel, pixelwidth)
+        
+        if self.directory:
+            # write beside and rename over, so readers never see half a file
+            handle, filename = mkstemp(dir=self.directory, prefix='tmp-')
+            write(handle, skeleton.wkb)
+            close(handle)
+            rename(filename, join(self.directory, name))
         else:
-            output.write(token)
+            self.s3.new_key(join(self.prefix, name)).set_contents_from_string(skeleton.wkb)
+    
+    def _name(self, hash, zoomlevel, pixelwidth):
+        return '%s-%d-%d-%s.wkb' % (skeletron_version, zoomlevel, pixelwidth, hash)
 
-    output.close()
+def generalize_features(renewal, features, output_keyname, zoomlevel, pixelwidth, limits=None, cache=None, presimplifier=None):
+    ''' Generate generalized GeoJSON features one at a time, in this process.
+        
+        Raises Superseded if the lease on the output is lost meanwhile.
+        Limits is an optional FeatureLimits, cache an optional
+        SkeletonCache to look in before generalizing anything, and
+        presimplifier an optional Presimplifier to apply first.
+    '''
+    for (id, properties, shape) in features:
+        if renewal.lost.is_set():
+            raise Superseded(output_keyname)
+        
+        try:
+            if presimplifier:
+                shape = presimplifier.simplify(shape, zoomlevel)
+            
+            # hash what Skeletron will see, so each simplification has its own cache key
+            hash = (limits or cache) and sha1(shape.wkb).hexdigest()
+            
+            try:
+                skeleton = cache and cache.get(hash, zoomlevel, pixelwidth)
+            except Exception, e:
+                # a cache that can't be read is no worse than a miss
+                logging.warning('%s: cache not read, %s' % (output_keyname, str(e)))
+                skeleton = None
+            
+            if not skeleton:
+                if limits:
+                    skeleton = limits.generalize(id, hash, shape, output_keyname, zoomlevel, pixelwidth)
+                else:
+                    skeleton = generalize_geometry(shape, pixelwidth, zoomlevel)
+                
+                # a quarantined feature's skeleton came from the simplified fallback
+                if skeleton and cache and not (limits and hash in limits.quarantined):
+                    try:
+                        cache.put(hash, zoomlevel, pixelwidth, skeleton)
+                    except Exception, e:
+                        logging.warning('%s: not cached, %s' % (output_keyname, str(e)))
+        
+        except Exception, e:
+            logging.error('%s: %s' % (output_keyname, str(e)))
+            continue
+        
+        if not skeleton:
+            continue
+        
+        properties = dict(properties, zoomlevel=zoomlevel, pixelwidth=pixelwidth)
+        feature = dict(type='Feature', properties=properties, geometry=skeleton.__geo_interface__)
+        
+        if id is not None:
+            feature['id'] = id
+        
+        yield feature
+
+def publish_generalized(s3, renewal, features, output_keyname, zoomlevel, pixelwidth, garbage, limits=None, cache=None, presimplifier=None):
+    ''' Generalize parsed features at one zoom in this process and upload the result.
+        
+        Same return value and garbage handling as publish_output().
+    '''
+    handle, filename_output = mkstemp(dir='.', prefix='output-', suffix='.json.bz2')
+    close(handle)
+    
+    garbage.add(filename_output)
+    output = CompressedOutput(filename_output)
+    
+    hits, misses = cache and (cache.hits, cache.misses) or (0, 0)
+    before, after = presimplifier and (presimplifier.before, presimplifier.after) or (0, 0)
+    
+    try:
+        generalized = generalize_features(renewal, features, output_keyname, zoomlevel, pixelwidth, limits, cache, presimplifier)
+        count = write_feature_collection(output, generalized, '%.5f')
+    
+    except Superseded:
+        logging.info('Killing %s' % output_keyname)
+        return False
+    
+    finally:
+        output.close()
+    
+    logging.info('Generalized %d of %d features for %s' % (count, len(features), output_keyname))
+    
+    if cache:
+        logging.info('%s: %d cached, %d new' % (output_keyname, cache.hits - hits, cache.misses - misses))
+    
+    if presimplifier:
+        before, after = presimplifier.before - before, presimplifier.after - after
+        logging.info('%s: presimplified %d vertices to %d at zoom %d (%.1f%% fewer)' % (output_keyname, before, after, zoomlevel, 100. * (before - after) / max(before, 1)))
+    
+    output_key = s3.new_key(output_keyname)
+    output_key.set_contents_from_filename(filename_output, policy='public-read')
+    
+    return True
+
+def get_leases(s3, lease_dir, lease_duration):
+    ''' Leases in a shared local directory if one is given, or else in S3.
+    '''
+    if lease_dir:
+        return DirectoryLeases(lease_dir, lease_duration)
+    
+    return S3Leases(s3, lease_duration)
+
+def remove_garbage(garbage):
+    '''
+    '''
+    for filename in garbage:
+        logging.info('Deleting %s' % filename)
+        remove(filename)
+    
+    garbage.clear()
+
+def part_keyname(output_keyname, part):
+    ''' Name of the key for one part of a split output.
+        
+        Part keys don't end in .bz2, so download-routes.py passes them by.
+    '''
+    index, count = part
     
-    return filename_output
+    return '%s.part-%d-of-%d' % (output_keyname, index + 1, count)
 
-def process_routes(bucketname, input_keyname, output_keyname, zoomlevel, pixelwidth):
+def assemble_output(s3, leases, keyname):
+    ''' Join the parts of a split output into the output itself, once all are done.
+        
+        Called with the name of any one part key. Whoever finishes the last
+        part does the joining, and the parts are removed afterwards. Errors
+        are logged rather than raised, so a caller can go on to other work.
+    '''
+    try:
+        join_parts(s3, leases, keyname)
+    except Exception, e:
+        logging.info('Errored assembling %s: %s' % (part_pat.sub('', keyname), str(e)))
+
+def join_parts(s3, leases, keyname):
     '''
     '''
+    output_keyname = part_pat.sub('', keyname)
+    count = int(part_pat.search(keyname).group(2))
+    part_keynames = [part_keyname(output_keyname, (index, count)) for index in range(count)]
+    
+    if s3.get_key(output_keyname) is not None:
+        return
+    
+    if [name for name in part_keynames if s3.get_key(name) is None]:
+        # other parts are still in progress
+        return
+    
+    if not leases.claim(output_keyname):
+        return
+    
+    garbage = set()
+    
+    try:
+        #
+        # Another assembler may have finished and removed the parts
+        # between the checks above and the claim, so check again.
+        #
+        if s3.get_key(output_keyname) is not None:
+            return
+        
+        part_keys = [s3.get_key(name) for name in part_keynames]
+        
+        if None in part_keys:
+            return
+        
+        handle, filename_output = mkstemp(dir='.', prefix='output-', suffix='.json.bz2')
+        close(handle)
+        
+        garbage.add(filename_output)
+        output = CompressedOutput(filename_output)
+        
+        def part_features():
+            for part_key in part_keys:
+                filename_part = download_input(part_key)
+                garbage.add(filename_part)
+                
+                for feature in stream_features(BZ2File(filename_part)):
+                    yield feature
+        
+        try:
+            count = write_feature_collection(output, part_features(), '%.5f')
+        finally:
+            output.close()
+        
+        output_key = s3.new_key(output_keyname)
+        output_key.set_contents_from_filename(filename_output, policy='public-read')
+        
+        for name in part_keynames:
+            s3.delete_key(name)
+        
+        logging.info('Assembled %s from %d parts, %d features' % (output_keyname, len(part_keynames), count))
+    
+    finally:
+        leases.release(output_keyname)
+        remove_garbage(garbage)
+
+def process_routes(bucketname, input_keyname, output_keyname, zoomlevel, pixelwidth, in_process=False, lease_dir=None, lease_duration=600, part=None, feature_limits=None, cache_location=None, presimplify=None):
+    ''' Generalize one input at one zoom.
+        
+        With part, an (index, count) tuple, output_keyname is a part key
+        and only that share of the input's features is generalized.
+        Feature_limits are the (seconds, megabytes, quarantine prefix,
+        quarantine directory, fallback) arguments for a FeatureLimits, cache_location the
+        (S3 prefix, directory) arguments for a SkeletonCache, and
+        presimplify the pixels argument for a Presimplifier, all used
+        in_process.
+    '''
     s3 = connect_s3().get_bucket(bucketname)
+    leases = get_leases(s3, lease_dir, lease_duration)
+    
+    if part and s3.get_key(part_pat.sub('', output_keyname)) is not None:
+        logging.info('Skipping %s' % output_keyname)
+        return
     
     if s3.get_key(output_keyname) is not None:
         logging.info('Skipping %s' % output_keyname)
+        
+        if part:
+            # this may have been the last part, with no one left to assemble it
+            assemble_output(s3, leases, output_keyname)
+        
+        return
+    
+    
+    if not leases.claim(output_keyname):
+        logging.info('Skipping %s, claimed elsewhere' % output_keyname)
         return
     
     logging.info('Starting %s' % output_keyname)
 
-    garbage = set()
+    renewal = Renewal(leases, output_keyname)
+    garbage, start = set(), time()
 
     try:
         input_key = s3.get_key(input_keyname)
@@ -137,68 +831,468 @@ def process_routes(bucketname, input_keyname, output_keyname, zoomlevel, pixelwi
         filename_input = download_input(input_key)
         garbage.add(filename_input)
 
-        filename_thruput, filename_stderr = generalize_input(filename_input, output_keyname, zoomlevel, pixelwidth)
-        garbage.add(filename_stderr)
-
-        if filename_thruput is None:
-            # Probably killed?
-            return
-
-        stderr_key = s3.new_key(output_keyname + '.stderr')
-        stderr_key.set_contents_from_filename(filename_stderr, policy='public-read')
+        if in_process:
+            limits = feature_limits and FeatureLimits(s3, *feature_limits)
+            cache = cache_location and SkeletonCache(s3, *cache_location)
+            presimplifier = presimplify and Presimplifier(presimplify)
+            published = publish_generalized(s3, renewal, load_features(filename_input, part), output_keyname, zoomlevel, pixelwidth, garbage, limits, cache, presimplifier)
+        else:
+            if part:
+                filename_input = extract_part(filename_input, part)
+                garbage.add(filename_input)
+            
+            published = publish_output(s3, renewal, filename_input, output_keyname, zoomlevel, pixelwidth, garbage)
         
-        garbage.add(filename_thruput)
-        geojson = modify_throughput(filename_thruput, zoomlevel, 15)
+        if not published:
+            return
         
-        filename_output = encode_output(geojson)
-        garbage.add(filename_output)
-
-        output_key = s3.new_key(output_keyname)
-        output_key.set_contents_from_filename(filename_output, policy='public-read')
+        if part:
+            assemble_output(s3, leases, output_keyname)
         
     except Exception, e:
         logging.info('Errored %s: %s' % (output_keyname, str(e)))
     
     else:
         logging.info('Finished %s' % output_keyname)
+        return [(output_keyname, time() - start)]
     
     finally:
-        for filename in garbage:
-            logging.info('Deleting %s' % filename)
-            remove(filename)
+        renewal.stop()
+        remove_garbage(garbage)
+
+def process_routes_zooms(bucketname, input_keyname, outputs, pixelwidth, in_process=False, lease_dir=None, lease_duration=600, part=None, feature_limits=None, cache_location=None, presimplify=None):
+    ''' Download one input, then generalize it at each zoom.
+        
+        Outputs is a list of (output key name, zoom level) tuples. The input
+        is parsed once for in_process, or else decompressed once for
+        a skeletron-generalize.py subprocess at each zoom.
+        
+        Returns (output key name, seconds) for each finished output.
+        With part, the output key names are part keys, and feature_limits,
+        cache_location and presimplify apply as in process_routes().
+    '''
+    s3 = connect_s3().get_bucket(bucketname)
+    leases = get_leases(s3, lease_dir, lease_duration)
+    
+    pending, renewals = [], {}
+    garbage, finished = set(), []
+    
+    try:
+        #
+        # Claim every zoom that's left before downloading anything,
+        # and hold the claims until each zoom is finished. Renewals
+        # are stopped below even if a later claim here fails.
+        #
+        for (output_keyname, zoomlevel) in outputs:
+            if part and s3.get_key(part_pat.sub('', output_keyname)) is not None:
+                logging.info('Skipping %s' % output_keyname)
+            
+            elif s3.get_key(output_keyname) is not None:
+                logging.info('Skipping %s' % output_keyname)
+                
+                if part:
+                    assemble_output(s3, leases, output_keyname)
+            
+            elif not leases.claim(output_keyname):
+                logging.info('Skipping %s, claimed elsewhere' % output_keyname)
+            
+            else:
+                pending.append((output_keyname, zoomlevel))
+                renewals[output_keyname] = Renewal(leases, output_keyname)
+        
+        if not pending:
+            return
+        
+        input_key = s3.get_key(input_keyname)
+        
+        filename_input = download_input(input_key)
+        garbage.add(filename_input)
+        
+        if in_process:
+            limits = feature_limits and FeatureLimits(s3, *feature_limits)
+            cache = cache_location and SkeletonCache(s3, *cache_location)
+            presimplifier = presimplify and Presimplifier(presimplify)
+            source, publish = load_features(filename_input, part), partial(publish_generalized, limits=limits, cache=cache, presimplifier=presimplifier)
+        elif part:
+            source, publish = extract_part(filename_input, part), publish_output
+            garbage.add(source)
+        else:
+            source, publish = decompress_input(filename_input), publish_output
+            garbage.add(source)
+        
+        for (output_keyname, zoomlevel) in pending:
+            logging.info('Starting %s' % output_keyname)
+            
+            renewal = renewals.pop(output_keyname)
+            zoom_garbage, start = set(), time()
+            
+            try:
+                if not publish(s3, renewal, source, output_keyname, zoomlevel, pixelwidth, zoom_garbage):
+                    continue
+                
+                logging.info('Finished %s' % output_keyname)
+                finished.append((output_keyname, time() - start))
+                
+                if part:
+                    assemble_output(s3, leases, output_keyname)
+            
+            except Exception, e:
+                # carry on with the other zooms either way
+                logging.info('Errored %s: %s' % (output_keyname, str(e)))
+            
+            finally:
+                renewal.stop()
+                remove_garbage(zoom_garbage)
+    
+    except Exception, e:
+        logging.info('Errored %s: %s' % (input_keyname, str(e)))
+    
+    finally:
+        for renewal in renewals.values():
+            renewal.stop()
+        
+        remove_garbage(garbage)
+    
+    return finished
+
+def measured(function, args):
+    ''' Run a task function, return its result and the peak memory it used.
+        
+        Errors are logged instead of raised, so the pool callback
+        that gives back the task's memory always gets called.
+    '''
+    peak = PeakMemory()
+    
+    try:
+        result = function(*args)
+    except Exception, e:
+        logging.error('%s%s: %s' % (function.__name__, repr(args[:3]), str(e)))
+        result = None
+    
+    return result, peak.stop()
 
-def get_tasks(s3, prefix, zooms):
+def split_counts(input_keys, split_factor, max_parts):
+    ''' Return a dictionary of input key names and how many parts to split each into.
+        
+        Inputs over split_factor times the median size are split into
+        parts of about the median size, so they finish with the rest.
     '''
+    sizes = sorted([input_key.size for input_key in input_keys])
+    
+    if not split_factor or not sizes:
+        return dict()
+    
+    median = max(sizes[len(sizes) / 2], 1)
+    
+    return dict([(input_key.name, min(max_parts, int(ceil(input_key.size / float(median)))))
+                 for input_key in input_keys if input_key.size > split_factor * median])
+
+def get_tasks(s3, prefix, zooms, multi_zoom=False, split_factor=0, max_parts=8):
+    ''' Return a list of (input, output, zoom, part, size) tasks, or (input, outputs, part, size) for multi_zoom.
+        
+        Part is None, or an (index, count) tuple for one part of a split
+        input, with its output key names changed to part key names.
     '''
     tasks = []
     
-    for (zoomlevel, input_key) in product(zooms, s3.list(prefix=prefix)):
+    input_keys = list(s3.list(prefix=prefix))
+    counts = split_counts(input_keys, split_factor, max_parts)
     
+    for input_key in input_keys:
+        count = counts.get(input_key.name, 1)
+        parts = (count > 1) and [(index, count) for index in range(count)] or [None]
+        
+        if count > 1:
+            logging.info('Splitting %s into %d parts' % (input_key.name, count))
+        
         dir, file = split(input_key.name)
-        output_keyname = join(dirname(dir), join('output', '%d-%s' % (zoomlevel, file)))
+        output_keynames = [(join(dirname(dir), join('output', '%d-%s' % (zoomlevel, file))), zoomlevel)
+                           for zoomlevel in zooms]
         
-        task = input_key.name, output_keyname, zoomlevel
-        tasks.append(task)
+        for part in parts:
+            outputs = [(part and part_keyname(name, part) or name, zoom) for (name, zoom) in output_keynames]
+            size = input_key.size / count
+            
+            if multi_zoom:
+                tasks.append((input_key.name, outputs, part, size))
+            else:
+                tasks.extend([(input_key.name, name, zoom, part, size) for (name, zoom) in outputs])
     
     return tasks
 
+def task_outputs(task, multi_zoom):
+    ''' Names of a task's outputs without the run directory, as timings are kept.
+    '''
+    if multi_zoom:
+        return [split(output_keyname)[1] for (output_keyname, zoomlevel) in task[1]]
+    
+    return [split(task[1])[1]]
+
+def order_tasks(tasks, multi_zoom, timings):
+    ''' Sort tasks with the largest predicted cost first.
+        
+        Starting the longest tasks first keeps one big input from starting
+        last and holding up the whole fleet. An output's cost is its time
+        from an earlier run if there is one, or its input size scaled by
+        the seconds per byte seen across all earlier runs.
+    '''
+    timed = [(task[-1], timings[name]) for task in tasks
+             for name in task_outputs(task, multi_zoom) if name in timings]
+    
+    timed_size = sum([size for (size, seconds) in timed])
+    rate = timed_size and sum([seconds for (size, seconds) in timed]) / float(timed_size) or 1.
+    
+    def cost(task):
+        return sum([timings.get(name, task[-1] * rate) for name in task_outputs(task, multi_zoom)])
+    
+    return sorted(tasks, key=cost, reverse=True)
+
+class TaskLog (object):
+    ''' Tab-separated records from finished tasks, kept for later runs.
+        
+        Records are appended to a local file if one is given. With a
+        prefix, each run also uploads its new records as one key under
+        that prefix in S3 when it's done, and reads back the keys from
+        every earlier run, so records outlive the instances they're from.
+    '''
+    def __init__(self, s3, filename=None, prefix=None):
+        self.s3 = s3
+        self.filename = filename
+        self.prefix = prefix
+        self.records = []
+    
+    def lines(self):
+        ''' Return every earlier record, from the local file and then from S3 oldest first.
+        '''
+        lines = []
+        
+        if self.filename and exists(self.filename):
+            lines.extend(open(self.filename).read().splitlines())
+        
+        if self.prefix:
+            for key in self.s3.list(prefix=self.prefix + '/'):
+                lines.extend(key.get_contents_as_string().splitlines())
+        
+        return [line for line in lines if line]
+    
+    def append(self, line):
+        '''
+        '''
+        self.records.append(line)
+        
+        if self.filename:
+            file = open(self.filename, 'a')
+            print >> file, line
+            file.close()
+    
+    def save(self):
+        ''' Upload this run's records, if there's a prefix to keep them under.
+        '''
+        if not self.prefix or not self.records:
+            return
+        
+        # S3 lists keys by name, so starting with the time keeps earlier runs first
+        name = '%s/%010d-%s-%d.tsv' % (self.prefix, time(), gethostname(), getpid())
+        self.s3.new_key(name).set_contents_from_string('\n'.join(self.records) + '\n')
+
+def load_timings(lines):
+    ''' Read tab-separated output names and seconds, later lines winning.
+        
+        Names are kept without their run directory, so that timings
+        from one run's outputs apply to the same outputs in the next.
+    '''
+    timings = dict()
+    
+    for line in lines:
+        name, seconds = line.rsplit('\t', 1)
+        timings[split(name)[1]] = float(seconds)
+    
+    return timings
+
+def load_memory_log(lines):
+    ''' Read tab-separated input key names, input sizes, and peak bytes used.
+    '''
+    records = []
+    
+    for line in lines:
+        name, size, peak = line.split('\t')
+        records.append((int(size), int(peak)))
+    
+    return records
+
+def memory_per_byte(records, default, base):
+    ''' Bytes of memory per input byte, calibrated from earlier runs if there are any.
+        
+        Uses the 90th percentile of observed ratios rather than the mean,
+        since guessing low is what gets an instance killed.
+    '''
+    ratios = sorted([max(peak - base, 0) / float(size) for (size, peak) in records if size])
+    
+    if not ratios:
+        return default
+    
+    return ratios[int(len(ratios) * .9)]
+
+optparser = OptionParser(usage="""%prog [options] <bucket> <prefix> <zoom> [<zoom>...]""")
+
+defaults = dict(multi_zoom=False, worker='inprocess', lease_dir=None, lease_duration=600, split_factor=4., max_parts=8, feature_seconds=900, feature_megabytes=2048, quarantine_prefix='quarantine', quarantine_dir=None, quarantined='simplify', cache=True, cache_prefix='skeleton-cache', cache_dir=None, presimplify=None, order='size', timings=None, log_prefix=None, memory_budget=int(sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') * .8 / 1048576), memory_base=100, memory_per_byte=30., memory_log=None)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('-m', '--multi-zoom', dest='multi_zoom', action='store_true',
+                     help='Make one task per input that downloads it once and generalizes it at every zoom, instead of one task per input and zoom.')
+
+optparser.add_option('-w', '--worker', dest='worker', type='choice', choices=('inprocess', 'subprocess'),
+                     help='Generalize with Skeletron imported once into each pool process ("inprocess"), or with a skeletron-generalize.py process per task ("subprocess"). Default "%(worker)s", falling back to "subprocess" if Skeletron can\'t be imported.' % defaults)
+
+optparser.add_option('--split-factor', dest='split_factor', type='float',
+                     help='Split inputs bigger than this many times the median input size into parts that other workers can take, default %(split_factor).1f. Zero to never split.' % defaults)
+
+optparser.add_option('--max-parts', dest='max_parts', type='int',
+                     help='Most parts to split one input into, default %(max_parts)d.' % defaults)
+
+optparser.add_option('--feature-seconds', dest='feature_seconds', type='int',
+                     help='Seconds of in-process generalization allowed per feature before it\'s quarantined, default %(feature_seconds)d. Zero for no limit.' % defaults)
+
+optparser.add_option('--feature-megabytes', dest='feature_megabytes', type='int',
+                     help='Megabytes of new memory allowed per feature before it\'s quarantined, default %(feature_megabytes)d. Zero for no limit.' % defaults)
+
+optparser.add_option('--quarantine-prefix', dest='quarantine_prefix',
+                     help='Keep quarantined feature records under this prefix in the bucket, so later runs skip them too. Default "%(quarantine_prefix)s".' % defaults)
+
+optparser.add_option('--quarantine-dir', dest='quarantine_dir',
+                     help='Keep quarantined feature records in this directory instead of in the bucket.')
+
+optparser.add_option('--quarantined', dest='quarantined', type='choice', choices=('skip', 'simplify'),
+                     help='What to do with already-quarantined features: "skip" them, or "simplify" them to one pixel and try once more. Default "%(quarantined)s".' % defaults)
+
+optparser.add_option('--cache-prefix', dest='cache_prefix',
+                     help='Keep generalized geometries from in-process workers under this prefix in the bucket, for later runs to reuse. Default "%(cache_prefix)s".' % defaults)
+
+optparser.add_option('--cache-dir', dest='cache_dir',
+                     help='Keep generalized geometries in this directory instead of in the bucket.')
+
+optparser.add_option('--no-cache', dest='cache', action='store_false',
+                     help='Generalize every feature, without looking for earlier results.')
+
+optparser.add_option('--presimplify', dest='presimplify', type='float',
+                     help='Simplify each feature to within this many pixels at each zoom before generalizing it, e.g. 0.5. Only for in-process workers.')
+
+optparser.add_option('-o', '--order', dest='order', type='choice', choices=('size', 'random'),
+                     help='Start tasks with the largest predicted cost first ("size"), or in "random" order. Default "%(order)s".' % defaults)
+
+optparser.add_option('-t', '--timings', dest='timings',
+                     help='File of task timings from earlier runs to predict costs with, appended to as tasks finish.')
+
+optparser.add_option('--log-prefix', dest='log_prefix',
+                     help='Also keep task timings and peak memory under "<prefix>/timings" and "<prefix>/memory" in the bucket, read at the start and added to at the end of each run.')
+
+optparser.add_option('--memory-budget', dest='memory_budget', type='int',
+                     help='Megabytes of estimated task memory to allow at once, default %(memory_budget)d (80%% of this machine).' % defaults)
+
+optparser.add_option('--memory-base', dest='memory_base', type='int',
+                     help='Megabytes of memory a task uses regardless of input size, default %(memory_base)d.' % defaults)
+
+optparser.add_option('--memory-per-byte', dest='memory_per_byte', type='float',
+                     help='Bytes of memory a task uses per byte of compressed input when there\'s no --memory-log to go by, default %(memory_per_byte).0f.' % defaults)
+
+optparser.add_option('--memory-log', dest='memory_log',
+                     help='File of peak task memory from earlier runs to estimate memory with, appended to as tasks finish.')
+
+optparser.add_option('-l', '--lease-dir', dest='lease_dir',
+                     help='Keep work claims as files in this shared directory instead of as .lease keys in the bucket.')
+
+optparser.add_option('--lease-duration', dest='lease_duration', type='int',
+                     help='Seconds a work claim lasts without renewal, default %(lease_duration)d.' % defaults)
+
 if __name__ == '__main__':
 
-    bucketname, prefix = argv[1:3]
-    zooms = map(int, argv[3:])
+    opts, args = optparser.parse_args()
+    
+    if len(args) < 3:
+        optparser.error('Need a bucket, a prefix, and at least one zoom level.')
+    
+    bucketname, prefix = args[:2]
+    zooms = map(int, args[2:])
 
     logging.basicConfig(format='%(levelname)s, %(process)d: %(message)s', level=logging.INFO)
     
+    if opts.worker == 'inprocess' and generalize_geometry is None:
+        logging.warning('Skeletron not importable, falling back to subprocess workers')
+        opts.worker = 'subprocess'
+    
+    if opts.presimplify and opts.worker == 'subprocess':
+        logging.warning('Subprocess workers generalize full-resolution geometry, ignoring --presimplify')
+    
+    in_process = (opts.worker == 'inprocess')
+    feature_limits = (opts.feature_seconds, opts.feature_megabytes, opts.quarantine_prefix, opts.quarantine_dir, opts.quarantined)
+    cache_location = opts.cache and (opts.cache_prefix, opts.cache_dir) or None
+    
     s3 = connect_s3().get_bucket(bucketname)
-    pool = Pool()
+    timings_log = TaskLog(s3, opts.timings, opts.log_prefix and join(opts.log_prefix, 'timings'))
+    memory_log = TaskLog(s3, opts.memory_log, opts.log_prefix and join(opts.log_prefix, 'memory'))
+    
+    if opts.memory_log or opts.log_prefix:
+        #
+        # A fresh pool process for every task, so that each peak is that
+        # task's own and not left over from an earlier one. Skeletron is
+        # imported before the fork, so this costs little more than a fork.
+        #
+        pool = Pool(maxtasksperchild=1)
+    else:
+        pool = Pool()
     
     logging.info('Getting tasks')
-    tasks = get_tasks(s3, prefix, zooms)
+    tasks = get_tasks(s3, prefix, zooms, opts.multi_zoom, opts.split_factor, opts.max_parts)
 
-    shuffle(tasks)
+    if opts.order == 'random':
+        shuffle(tasks)
+    else:
+        tasks = order_tasks(tasks, opts.multi_zoom, load_timings(timings_log.lines()))
+    
+    #
+    # Tasks are only handed to the pool once their estimated memory fits
+    # in the budget, and give it back when they finish. Peak memory from
+    # finished tasks goes to memory_log to calibrate later estimates.
+    #
+    budget = MemoryBudget(opts.memory_budget * 1048576)
+    base = opts.memory_base * 1048576
+    per_byte = memory_per_byte(load_memory_log(memory_log.lines()), opts.memory_per_byte, base)
     
-    for (input_keyname, output_keyname, zoomlevel) in tasks:
-        pool.apply_async(process_routes, (bucketname, input_keyname, output_keyname, zoomlevel, 15))
+    logging.info('Estimating %.1f bytes of memory per input byte' % per_byte)
+    
+    def make_callback(input_keyname, size, estimate):
+        def callback((timings, peak)):
+            budget.release(estimate)
+            
+            if not timings:
+                # skipped or failed, so neither time nor memory mean much
+                return
+            
+            logging.info('%s used %dMB, estimated %dMB' % (input_keyname, peak / 1048576, estimate / 1048576))
+            
+            for (output_keyname, seconds) in timings:
+                timings_log.append('%s\t%.1f' % (split(output_keyname)[1], seconds))
+            
+            memory_log.append('%s\t%d\t%d' % (input_keyname, size, peak))
+        
+        return callback
+    
+    for task in tasks:
+        if opts.multi_zoom:
+            input_keyname, outputs, part, size = task
+            function, args = process_routes_zooms, (bucketname, input_keyname, outputs, 15, in_process, opts.lease_dir, opts.lease_duration, part, feature_limits, cache_location, opts.presimplify)
+        else:
+            input_keyname, output_keyname, zoomlevel, part, size = task
+            function, args = process_routes, (bucketname, input_keyname, output_keyname, zoomlevel, 15, in_process, opts.lease_dir, opts.lease_duration, part, feature_limits, cache_location, opts.presimplify)
+        
+        estimate = int(base + per_byte * size)
+        budget.admit(estimate)
+        
+        pool.apply_async(measured, (function, args), callback=make_callback(input_keyname, size, estimate))
         
     pool.close()
     pool.join()
+    
+    timings_log.save()
+    memory_log.save()
@@ -22,5 +22,8 @@ python launch-routes.py osm-streets-routes-data $DIR
 echo "Verifying output (verify-routes)..."
 python verify-routes.py osm-streets-routes-data/$DIR/routes-geojson/ osm-streets-routes-data/$DIR/output/
 
+# every chunk in this run has outputs now, so later runs can carry them forward
+cp $DIR/manifest.json routes-manifest.json
+
 echo "Downloading route data (download-routes)..."
-python download-routes.py -u gis -p gis osm-streets-routes-data/$DIR/output/ gis
+python download-routes.py -m $DIR/manifest.json -u gis -p gis osm-streets-routes-data/$DIR/output/ gis
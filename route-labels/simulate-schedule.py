@@ -0,0 +1,79 @@
+from sys import stdin
+from random import seed, shuffle, lognormvariate
+from heapq import heapify, heapreplace
+from optparse import OptionParser
+
+import logging
+
+def makespan(costs, workers):
+    '''
+    '''
+    #
+    # Each task goes to whichever worker frees up first, in list order,
+    # the way a multiprocessing pool hands out queued tasks.
+    #
+    finishes = [0.] * workers
+    heapify(finishes)
+    
+    for cost in costs:
+        heapreplace(finishes, finishes[0] + cost)
+    
+    return max(finishes)
+
+def read_sizes(opts, args):
+    '''
+    '''
+    if opts.random:
+        seed(0)
+        return [lognormvariate(16, 1.5) for i in range(opts.random)]
+    
+    file = (args and args[0] != '-') and open(args[0]) or stdin
+    
+    return [float(line.split()[0]) for line in file if line.strip()]
+
+optparser = OptionParser(usage="""%prog [options] [<sizes file>]
+
+Compares the makespan of random and longest-first task ordering for a list
+of task sizes, one per line, e.g. input object sizes in bytes. Task time is
+taken to be size to the power of --exponent.""")
+
+defaults = dict(workers=32, rounds=100, exponent=1., random=None, loglevel=logging.INFO)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('-w', '--workers', dest='workers', type='int',
+                     help='Number of worker processes across the fleet, default %(workers)d.' % defaults)
+
+optparser.add_option('-r', '--rounds', dest='rounds', type='int',
+                     help='Number of random orderings to average, default %(rounds)d.' % defaults)
+
+optparser.add_option('-e', '--exponent', dest='exponent', type='float',
+                     help='Task time grows with size to this power, default %(exponent).1f.' % defaults)
+
+optparser.add_option('--random', dest='random', type='int',
+                     help='Make up this many log-normal task sizes instead of reading a file.')
+
+if __name__ == '__main__':
+
+    opts, args = optparser.parse_args()
+    
+    logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
+    
+    costs = [size ** opts.exponent for size in read_sizes(opts, args)]
+    
+    lpt_span = makespan(sorted(costs, reverse=True), opts.workers)
+    random_spans = []
+    
+    for round in range(opts.rounds):
+        shuffle(costs)
+        random_spans.append(makespan(costs, opts.workers))
+    
+    random_spans.sort()
+    random_span = sum(random_spans) / len(random_spans)
+    lower_bound = max(max(costs), sum(costs) / opts.workers)
+    
+    logging.info('%d tasks on %d workers' % (len(costs), opts.workers))
+    logging.info('Lower bound: %.0f' % lower_bound)
+    logging.info('Random order: %.0f mean, %.0f worst (%.2fx bound)' % (random_span, random_spans[-1], random_span / lower_bound))
+    logging.info('Largest first: %.0f (%.2fx bound)' % (lpt_span, lpt_span / lower_bound))
+    logging.info('Improvement: %.1f%%' % (100 * (random_span - lpt_span) / random_span))
@@ -0,0 +1,170 @@
+''' Tests for leases.py against a temporary directory and an in-memory bucket.
+
+Run with "python test-leases.py".
+'''
+from tempfile import mkdtemp
+from threading import Thread, Event
+from shutil import rmtree
+from time import time
+
+import unittest
+import json
+
+from leases import DirectoryLeases, S3Leases, Renewal
+
+def expired_lease(owner):
+    '''
+    '''
+    return json.dumps(dict(owner=owner, expires=time() - 1))
+
+class FakeKey (object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+    
+    def get_contents_as_string(self):
+        return self.bucket.contents[self.name]
+    
+    def set_contents_from_string(self, content):
+        self.bucket.contents[self.name] = content
+    
+    def delete(self):
+        del self.bucket.contents[self.name]
+
+class FakeBucket (object):
+
+    def __init__(self):
+        self.contents = dict()
+    
+    def get_key(self, name):
+        return (name in self.contents) and FakeKey(self, name) or None
+    
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+class DirectoryLeasesTests (unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='test-leases-')
+    
+    def tearDown(self):
+        rmtree(self.path)
+    
+    def test_claim_and_release(self):
+        first, second = DirectoryLeases(self.path), DirectoryLeases(self.path)
+        
+        self.assertTrue(first.claim('output/12-routes-000001.json.bz2'))
+        self.assertTrue(first.claim('output/12-routes-000001.json.bz2'))
+        self.assertFalse(second.claim('output/12-routes-000001.json.bz2'))
+        
+        first.release('output/12-routes-000001.json.bz2')
+        self.assertTrue(second.claim('output/12-routes-000001.json.bz2'))
+    
+    def test_renew_lost_lease(self):
+        first, second = DirectoryLeases(self.path), DirectoryLeases(self.path)
+        
+        self.assertTrue(first.claim('name'))
+        
+        with open(first._filename('name'), 'w') as file:
+            file.write(expired_lease(first.owner))
+        
+        self.assertTrue(second.claim('name'))
+        self.assertFalse(first.renew('name'))
+        self.assertTrue(second.renew('name'))
+    
+    def test_interleaved_takeover(self):
+        ''' One worker takes over an expired lease just after another has read it.
+        '''
+        first, second = DirectoryLeases(self.path), DirectoryLeases(self.path)
+        filename = second._filename('name')
+        
+        with open(filename, 'w') as file:
+            file.write(expired_lease('somebody-else'))
+        
+        read, claims = second._read, []
+        
+        def read_then_race(filename):
+            content = read(filename)
+            
+            if not claims:
+                # the first worker gets in between the second's read and its takeover
+                claims.append(first.claim('name'))
+            
+            return content
+        
+        second._read = read_then_race
+        claims.append(second.claim('name'))
+        
+        self.assertEqual(claims, [True, False])
+        self.assertEqual(json.loads(open(filename).read())['owner'], first.owner)
+    
+    def test_racing_takeovers(self):
+        ''' Many workers racing for one expired lease, only one wins.
+        '''
+        for round in range(20):
+            name = 'name-%d' % round
+            workers = [DirectoryLeases(self.path) for index in range(8)]
+            
+            with open(workers[0]._filename(name), 'w') as file:
+                file.write(expired_lease('somebody-else'))
+            
+            go, wins = Event(), []
+            
+            def claim(leases):
+                go.wait()
+                
+                if leases.claim(name):
+                    wins.append(leases.owner)
+            
+            threads = [Thread(target=claim, args=(leases, )) for leases in workers]
+            
+            for thread in threads:
+                thread.start()
+            
+            go.set()
+            
+            for thread in threads:
+                thread.join()
+            
+            self.assertEqual(len(wins), 1)
+            self.assertEqual(json.loads(open(workers[0]._filename(name)).read())['owner'], wins[0])
+
+class S3LeasesTests (unittest.TestCase):
+
+    def test_claim_expired_and_release(self):
+        bucket = FakeBucket()
+        first, second = S3Leases(bucket, settle=0), S3Leases(bucket, settle=0)
+        
+        self.assertTrue(first.claim('name'))
+        self.assertFalse(second.claim('name'))
+        
+        bucket.contents['name.lease'] = expired_lease(first.owner)
+        
+        self.assertTrue(second.claim('name'))
+        self.assertFalse(first.renew('name'))
+        
+        first.release('name')
+        self.assertTrue('name.lease' in bucket.contents)
+        
+        second.release('name')
+        self.assertFalse('name.lease' in bucket.contents)
+
+class RenewalTests (unittest.TestCase):
+
+    def test_lost_lease(self):
+        bucket = FakeBucket()
+        first, second = S3Leases(bucket, duration=.03, settle=0), S3Leases(bucket, settle=0)
+        
+        self.assertTrue(first.claim('name'))
+        renewal = Renewal(first, 'name')
+        
+        bucket.contents['name.lease'] = json.dumps(dict(owner=second.owner, expires=time() + 60))
+        
+        self.assertTrue(renewal.lost.wait(1))
+        renewal.stop()
+        
+        self.assertEqual(json.loads(bucket.contents['name.lease'])['owner'], second.owner)
+
+if __name__ == '__main__':
+    unittest.main()
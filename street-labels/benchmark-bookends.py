@@ -0,0 +1,117 @@
+from time import time
+from optparse import OptionParser
+
+import logging
+
+from psycopg2 import connect
+
+extract = __import__('extract-streets')
+
+def offset_bookends(db, opts):
+    '''
+    '''
+    # The previous generator from extract-streets.py, kept for comparison.
+    db.execute('SELECT COUNT(osm_id) FROM street_ids')
+    (streets_count, ) = db.fetchone()
+
+    for offset in range(0, streets_count, opts.count):
+
+        db.execute('''SELECT name FROM street_ids
+                      ORDER BY name LIMIT 1 OFFSET %d''' % offset)
+
+        low_street = db.fetchone()[0]
+
+        db.execute('''SELECT name FROM street_ids
+                      ORDER BY name LIMIT 1 OFFSET %d''' % (offset + opts.count))
+
+        if db.rowcount:
+            high_street = db.fetchone()[0]
+
+            db.execute('''SELECT COUNT(osm_id) FROM street_ids
+                          WHERE name >= %s AND name < %s''',
+                       (low_street, high_street))
+        else:
+            high_street = None
+
+            db.execute('''SELECT COUNT(osm_id) FROM street_ids
+                          WHERE name >= %s''',
+                       (low_street, ))
+
+        db.fetchone()
+
+        yield (low_street, high_street)
+
+def build_synthetic_table(db, opts):
+    '''
+    '''
+    db.execute('''
+        CREATE TEMPORARY TABLE street_ids
+        AS
+        SELECT id AS osm_id,
+               'Street ' || to_char(floor(random() * %d), 'FM0000000') AS name
+        FROM generate_series(1, %d) AS id
+        ''' % (opts.names, opts.rows))
+
+    db.execute('CREATE INDEX street_names ON street_ids(name)')
+    db.execute('CLUSTER street_ids USING street_names')
+    db.execute('ANALYZE street_ids')
+
+def time_bookends(generator, db, opts):
+    '''
+    '''
+    start = time()
+    bookends = list(generator(db, opts))
+
+    return bookends, time() - start
+
+optparser = OptionParser(usage="""%prog [options] <database>
+
+Compares generate_bookends() from extract-streets.py with the previous
+OFFSET-based generator on a synthetic street_ids table.""")
+
+defaults = dict(host='localhost', user='osm2pgsql', passwd=None, rows=500000, names=100000, count=5000, chunk_cost='rows', target_cost=None, street_table='street_ids', loglevel=logging.INFO)
+
+optparser.set_defaults(**defaults)
+
+optparser.add_option('--host', dest='host',
+                     help='Postgres hostname, default %(host)s.' % defaults)
+
+optparser.add_option('-u', '--user', dest='user',
+                     help='Postgres username, default "%(user)s".' % defaults)
+
+optparser.add_option('-p', '--passwd', dest='passwd',
+                     help='Postgres password, default "%(passwd)s".' % defaults)
+
+optparser.add_option('-r', '--rows', dest='rows', type='int',
+                     help='Number of synthetic street rows, default %(rows)d.' % defaults)
+
+optparser.add_option('-n', '--names', dest='names', type='int',
+                     help='Number of distinct synthetic names, default %(names)d.' % defaults)
+
+optparser.add_option('-c', '--count', dest='count', type='int',
+                     help='Rows per chunk, default %(count)d.' % defaults)
+
+if __name__ == '__main__':
+
+    opts, (dbname, ) = optparser.parse_args()
+
+    logging.basicConfig(level=opts.loglevel, format='%(levelname)08s - %(message)s')
+
+    db = connect(host=opts.host, database=dbname, user=opts.user, password=opts.passwd)
+    db = db.cursor()
+
+    build_synthetic_table(db, opts)
+
+    old_bookends, old_elapsed = time_bookends(offset_bookends, db, opts)
+    new_bookends, new_elapsed = time_bookends(extract.generate_bookends, db, opts)
+
+    # the old generator also made empty chunks inside names longer than a chunk
+    old_bookends = [(low, high) for (low, high) in old_bookends if low != high]
+    assert old_bookends == new_bookends, 'Bookends differ'
+
+    logging.info('%d chunks from %d rows and %d names' % (len(new_bookends), opts.rows, opts.names))
+    logging.info('OFFSET generator: %.3f seconds' % old_elapsed)
+    logging.info('Single-pass generator: %.3f seconds' % new_elapsed)
+    logging.info('Speedup: %.1fx' % (old_elapsed / max(new_elapsed, 1e-6)))
+
+    db.close()
@@ -13,6 +13,7 @@ import logging
 
 from boto import connect_s3
 from psycopg2 import connect
+from extracttools import carried_outputs
 
 mercator = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs'
 
@@ -85,6 +86,9 @@ optparser.add_option('-t', '--table', dest='table',
 optparser.add_option('-j', '--jobs', dest='jobs', type='int',
                      help='Number of processing jobs, default all.')
 
+optparser.add_option('-m', '--manifest', dest='manifest',
+                     help='Manifest from extract-streets.py, to also download outputs of unchanged chunks from earlier runs.')
+
 optparser.add_option('-v', '--verbose', dest='loglevel',
                      action='store_const', const=logging.DEBUG,
                      help='Output extra progress information.')
@@ -108,7 +112,12 @@ if __name__ == '__main__':
     tables = []
     pool = Pool(opts.jobs)
     
-    for (key, index) in zip(s3.list(aws_prefix), count(1)):
+    keys = [(key, basename(key.name)) for key in s3.list(aws_prefix)]
+    
+    if opts.manifest:
+        keys += carried_outputs(s3, opts.manifest, aws_prefix)
+    
+    for ((key, keyname), index) in zip(keys, count(1)):
         name = key.name
 
         if not name.endswith('.bz2'):
@@ -121,7 +130,7 @@ if __name__ == '__main__':
         key.get_contents_to_file(buffer)
         raw = decompress(buffer.getvalue())
         
-        base, ext = splitext(basename(name))
+        base, ext = splitext(keyname)
         handle, file = mkstemp(dir='.', suffix='.json')
         close(handle)
         
@@ -1,12 +1,11 @@
-from json import dump
 from time import time
+from hashlib import sha1
 from uuid import uuid1
-from bz2 import BZ2File
 from itertools import count, izip, groupby
 from optparse import OptionParser
 from multiprocessing import Pool
-from json import JSONEncoder
-from re import compile
+from threading import Thread, BoundedSemaphore, Event
+from Queue import Queue, Full
 
 import logging
 
@@ -14,110 +13,128 @@ from shapely.wkb import loads
 from shapely.geometry import MultiLineString
 from StreetNames import short_street_name
 from psycopg2 import connect, OperationalError
-
-float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
-charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
+from geojsonwriter import CompressedOutput, write_feature_collection
+from extracttools import build_masks, spool_records, unspool_records, load_manifest, update_manifest
 
 def build_temporary_tables(db, opts):
     '''
     '''
-    # SF Bay Area
-    geom = 'MakeBox2D(MakePoint(-123.117, 38.562), MakePoint(-120.981, 36.831))'
-    
-    # Medium areas: NYC, Uppsala, Manila, London, Shanghai
-    geom = "GeomFromText('MULTIPOLYGON(((-80.043640 45.130711, -67.969666 45.130711, -67.969666 35.981340, -80.043640 35.981340, -80.043640 45.130711)), ((11.604309 62.755983, 23.678284 62.755983, 23.678284 56.687916, 11.604309 56.687916, 11.604309 62.755983)), ((-6.112518 55.113728, 5.961456 55.113728, 5.961456 47.595977, -6.112518 47.595977, -6.112518 55.113728)), ((114.955444 20.365228, 127.029419 20.365228, 127.029419 8.700499, 114.955444 8.700499, 114.955444 20.365228)), ((115.460815 36.232089, 127.534790 36.232089, 127.534790 25.914821, 115.460815 25.914821, 115.460815 36.232089)))')"
+    if opts.bbox or opts.mask_file:
+        build_masks(db, opts)
+        
+        # an && test against the GiST-indexed masks table
+        mask_test = 'AND EXISTS (SELECT 1 FROM masks WHERE masks.way && %s.way)' % opts.table
     
-    # SF/Oakland
-    geom = 'MakeBox2D(MakePoint(-122.5225, 37.8867), MakePoint(-122.1510, 37.6974))'
+    else:
+        mask_test = ''
     
-    db.execute('''
-        CREATE TEMPORARY TABLE masks
-            AS SELECT (Dump(Transform(SetSrid(%(geom)s, 4326), 900913))).geom AS way
-        ''' % locals())
-
-    logging.debug('Selecting street_ids...')
+    logging.debug('Selecting %s...' % opts.street_table)
     
     start = time()
     
-    # db.execute('''
-    #     CREATE TEMPORARY TABLE street_ids
-    #     AS SELECT streets.osm_id, streets.name, streets.kind
-    #     FROM masks,
-    #     (
-    #         SELECT way, osm_id, name,
-    # 
-    #                (CASE WHEN highway IN ('motorway') THEN 'highway'
-    #                      WHEN highway IN ('trunk', 'primary') THEN 'major_road'
-    #                      ELSE 'minor_road' END) AS kind
-    # 
-    #         FROM %s
-    #         WHERE name IS NOT NULL
-    #           AND (highway IN ('trunk', 'primary') OR
-    #                highway IN ('secondary'))
-    #     ) AS streets
-    #     
-    #     WHERE streets.way && masks.way
-    #     ''' % opts.table)
+    if opts.connections:
+        #
+        # Other connections can't see temporary tables, so use a real one.
+        # Unlogged tables skip the write-ahead log and are almost as cheap.
+        # Its name is this run's own, see the end of this script.
+        #
+        table_type = 'UNLOGGED TABLE'
+    
+    else:
+        table_type = 'TEMPORARY TABLE'
     
     db.execute('''
-        CREATE TEMPORARY TABLE street_ids
+        CREATE %s %s
         AS
         SELECT osm_id, name, highway, way
         FROM %s
         WHERE name IS NOT NULL
           AND highway IN ('trunk', 'trunk_link', 'primary', 'primary_link',
                           'secondary', 'secondary_link', 'tertiary', 'tertiary_link')
-        ''' % opts.table)
+          %s
+        ''' % (table_type, opts.street_table, opts.table, mask_test))
     
     logging.debug('Indexing street names...')
     
-    db.execute('CREATE INDEX street_names ON street_ids(name)')
+    db.execute('CREATE INDEX %s_names ON %s(name)' % (opts.street_table, opts.street_table))
 
     logging.debug('Clustering street names...')
     
-    db.execute('CLUSTER street_ids USING street_names')
+    db.execute('CLUSTER %s USING %s_names' % (opts.street_table, opts.street_table))
     
     # make it possible to rollback to this point in the event of an error
     db.execute('COMMIT')
     
-    db.execute('SELECT COUNT(osm_id), COUNT(distinct name) FROM street_ids')
+    db.execute('SELECT COUNT(osm_id), COUNT(distinct name) FROM %s' % opts.street_table)
     streets_count, names_count = db.fetchone()
     
     logging.info('Found %d ways with %d unique names in %d seconds' % (streets_count, names_count, time() - start))
     
     return streets_count, names_count
 
-def generate_bookends(db, opts):
+def generate_bookends(db, opts, boundaries=()):
     '''
     '''
-    db.execute('SELECT COUNT(osm_id) FROM street_ids')
-    (streets_count, ) = db.fetchone()
-
-    for offset in range(0, streets_count, opts.count):
-        
-        db.execute('''SELECT name FROM street_ids
-                      ORDER BY name LIMIT 1 OFFSET %d''' % offset)
-        
-        low_street = db.fetchone()[0]
+    #
+    # One ordered scan of per-name counts and costs instead of two OFFSET
+    # queries and a COUNT per chunk. A new chunk starts every target_cost
+    # along the running total, and its bookend is the name of the group
+    # holding that point. Counting rows with a target of opts.count cuts
+    # chunks exactly where "ORDER BY name OFFSET n" used to.
+    #
+    # Names in boundaries start a chunk no matter what, so that chunks
+    # line up with the ones from a previous run, see load_manifest().
+    # Between those, chunks are only cut at twice the target cost.
+    #
+    costs = dict(rows='COUNT(osm_id)', points='SUM(ST_NPoints(way))', length='SUM(ST_Length(way))')
+    
+    db.execute('''SELECT name, COUNT(osm_id), %s FROM %s
+                  GROUP BY name ORDER BY name''' % (costs[opts.chunk_cost], opts.street_table))
+    
+    names = db.fetchall()
+    
+    if opts.target_cost:
+        target_cost = opts.target_cost
+    
+    elif opts.chunk_cost == 'rows':
+        target_cost = opts.count
+    
+    else:
+        # about as many chunks as counting rows would make, but even in cost
+        total_rows = sum([rows for (name, rows, cost) in names])
+        total_cost = sum([cost for (name, rows, cost) in names])
+        target_cost = float(total_cost) * opts.count / max(total_rows, 1) or opts.count
+    
+    step = boundaries and 2 * target_cost or target_cost
+    
+    logging.debug('Cutting chunks every %d in %s' % (step, opts.chunk_cost))
+    
+    bookends, offset, position, next_cut = [], 0, 0, 0
+    
+    for (name, rows, cost) in names:
+        if bookends and name in boundaries and bookends[-1][0] != name:
+            bookends.append((name, offset, position))
+            next_cut = position + step
         
-        db.execute('''SELECT name FROM street_ids
-                      ORDER BY name LIMIT 1 OFFSET %d''' % (offset + opts.count))
+        while not bookends or next_cut < position + cost:
+            # a group costing more than a step still starts just one chunk
+            if not bookends or bookends[-1][0] != name:
+                # remember where the group starts, for counting streets below
+                bookends.append((name, offset, position))
+            
+            next_cut += step
         
-        if db.rowcount:
-            high_street = db.fetchone()[0]
+        offset += rows
+        position += cost
+    
+    for (index, (low_street, low_offset, low_position)) in enumerate(bookends):
         
-            db.execute('''SELECT COUNT(osm_id) FROM street_ids
-                          WHERE name >= %s AND name < %s''',
-                       (low_street, high_street))
+        if index + 1 < len(bookends):
+            high_street, high_offset, high_position = bookends[index + 1]
         else:
-            high_street = None
-        
-            db.execute('''SELECT COUNT(osm_id) FROM street_ids
-                          WHERE name >= %s''',
-                       (low_street, ))
+            high_street, high_offset, high_position = None, offset, position
         
-        
-        logging.debug('%d streets between %s and %s' % (db.fetchone()[0], low_street, high_street))
+        logging.debug('%d streets costing %d %s between %s and %s' % (high_offset - low_offset, high_position - low_position, opts.chunk_cost, low_street, high_street))
         
         yield (low_street, high_street)
 
@@ -132,23 +149,29 @@ def get_street_multilines(db, opts, low_street, high_street):
         name_test = 'name >= %s AND name < %s'
         values = (low_street, high_street)
 
-    table = opts.table
+    street_table = opts.street_table
+    
+    if opts.itersize:
+        return stream_street_multilines(db, opts, name_test, values)
     
     try:
         #
         # Try to let Postgres do the grouping for us, it's faster.
+        # Lines are collected in osm_id order so that each multiline,
+        # and so its street_id() and its chunk's digest, comes out the
+        # same from one run to the next.
         #
         db.execute('''
             SELECT name, 'none' as kind, highway,
-                   AsBinary(Transform(Collect(way), 4326)) AS way_wkb
+                   AsBinary(Transform(Collect(way ORDER BY osm_id), 4326)) AS way_wkb
             
-            FROM street_ids
+            FROM %(street_table)s
             
             WHERE %(name_test)s
             GROUP BY name, highway
-            ORDER BY name''' % locals(), values)
+            ORDER BY name, highway''' % locals(), values)
     
-        multilines = [(name, kind, highway, loads(bytes(way_wkb)))
+        multilines = [(name, kind, highway, fetched_geometry(opts, way_wkb))
                       for (name, kind, highway, way_wkb) in db.fetchall()]
 
     except OperationalError, err:
@@ -164,10 +187,10 @@ def get_street_multilines(db, opts, low_street, high_street):
             SELECT name, 'none' as kind, highway,
                    AsBinary(Transform(way, 4326)) AS way_wkb
             
-            FROM street_ids
+            FROM %(street_table)s
             
             WHERE %(name_test)s
-            ORDER BY name, highway''' % locals(), values)
+            ORDER BY name, highway, osm_id''' % locals(), values)
         
         logging.debug('...executed...')
         
@@ -177,54 +200,266 @@ def get_street_multilines(db, opts, low_street, high_street):
         logging.debug('...fetched...')
         
         for ((name, kind, highway), group) in groups:
-            lines = [loads(bytes(way_wkb)) for (n, k, h, way_wkb) in group]
-            multilines.append((name, kind, highway, MultiLineString(lines)))
+            lines = [fetched_geometry(opts, way_wkb) for (n, k, h, way_wkb) in group]
+            multilines.append((name, kind, highway, fetched_multiline(opts, lines)))
     
         logging.debug('...collected.')
-        
+    
     return multilines
 
-def output_geojson_bzipped(index, streets):
+def fetched_geometry(opts, way_wkb):
     '''
     '''
-    try:
-        ids = [str(uuid1()) for (n, k, h, g) in streets]
-        geometries = [geom.__geo_interface__ for (n, k, h, geom) in streets]
+    if opts.transport == 'shapely':
+        return loads(bytes(way_wkb))
+    
+    # leave decoding to the encoder processes
+    return bytes(way_wkb)
+
+def fetched_multiline(opts, lines):
+    '''
+    '''
+    if opts.transport == 'shapely':
+        return MultiLineString(lines)
+    
+    # a list of WKB linestrings, see decoded_geometry()
+    return lines
+
+def decoded_geometry(geom):
+    '''
+    '''
+    if isinstance(geom, str):
+        return loads(geom)
+    
+    elif isinstance(geom, list):
+        return MultiLineString([loads(line) for line in geom])
+    
+    return geom
 
-        properties = [dict(name=short_street_name(n), long_name=n, kind=k, highway=h)
-                      for (n, k, h, g) in streets]
+def stream_street_multilines(db, opts, name_test, values):
+    '''
+    '''
+    #
+    # Named cursors live on the server, and only opts.itersize rows
+    # at a time make it over here. Grouping happens as rows arrive,
+    # so at most one name group is held in memory at once.
+    #
+    cursor = db.connection.cursor('street_multilines')
+    cursor.itersize = opts.itersize
+    street_table = opts.street_table
+    
+    try:
+        cursor.execute('''
+            SELECT name, 'none' as kind, highway,
+                   AsBinary(Transform(way, 4326)) AS way_wkb
+            
+            FROM %(street_table)s
+            
+            WHERE %(name_test)s
+            ORDER BY name, highway, osm_id''' % locals(), values)
         
-        features = [dict(type='Feature', id=id, properties=p, geometry=g)
-                    for (id, p, g) in zip(ids, properties, geometries)]
+        groups = groupby(cursor, lambda (n, k, h, w): (n, k, h))
         
-        geojson = dict(type='FeatureCollection', features=features)
-        encoder = JSONEncoder(separators=(',', ':'))
-        encoded = encoder.iterencode(geojson)
+        for ((name, kind, highway), group) in groups:
+            lines = [loads(bytes(way_wkb)) for (n, k, h, way_wkb) in group]
+            yield (name, kind, highway, MultiLineString(lines))
+    
+    finally:
+        cursor.close()
 
-        output = BZ2File('streets-%06d.json.bz2' % index, 'w')
+def prefetched(iterable, size):
+    '''
+    '''
+    #
+    # Pull items from iterable in a background thread, at most size ahead
+    # of the caller. Psycopg2 and GEOS both release the GIL while they work,
+    # so database fetches here overlap with encoding in the caller.
+    #
+    # If the caller stops early, the thread notices the stop event and
+    # closes iterable itself, so a named cursor behind it gets closed.
+    #
+    queue, stop = Queue(size), Event()
+    
+    def put(message):
+        while not stop.is_set():
+            try:
+                queue.put(message, timeout=.1)
+            except Full:
+                continue
+            else:
+                return True
         
-        for token in encoded:
-            if charfloat_pat.match(token):
-                # in python 2.7, we see a character followed by a float literal
-                output.write(token[0] + '%.6f' % float(token[1:]))
-            
-            elif float_pat.match(token):
-                # in python 2.6, we see a simple float literal
-                output.write('%.6f' % float(token))
+        return False
+    
+    def fetch():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    break
+        except Exception, e:
+            put((False, e))
+        else:
+            put((False, None))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    
+    thread = Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        while True:
+            more, item = queue.get()
             
+            if more:
+                yield item
+            elif item is None:
+                break
             else:
-                output.write(token)        
+                raise item
+    
+    finally:
+        stop.set()
+        thread.join()
+
+def cluster_lines(lines, distance):
+    '''
+    '''
+    #
+    # Single-linkage clusters: lines closer than distance end up together.
+    # Candidate pairs come from a sweep over bounding boxes sorted by minx,
+    # and a union-find forest keeps track of which cluster each line is in.
+    #
+    bounds = [line.bounds for line in lines]
+    parents = range(len(lines))
+    active = []
+    
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+    
+    for index in sorted(range(len(lines)), key=lambda i: bounds[i][0]):
+        minx, miny, maxx, maxy = bounds[index]
+        active = [other for other in active if bounds[other][2] + distance >= minx]
+        
+        for other in active:
+            if bounds[other][1] - distance > maxy or bounds[other][3] + distance < miny:
+                continue
+            
+            root, other_root = find(index), find(other)
+            
+            if root != other_root and lines[index].distance(lines[other]) <= distance:
+                parents[root] = other_root
+        
+        active.append(index)
+    
+    clusters = dict()
+    
+    for index in range(len(lines)):
+        clusters.setdefault(find(index), []).append(index)
+    
+    return [[lines[index] for index in cluster] for cluster in sorted(clusters.values())]
 
+def split_multiline(geom, cluster_distance):
+    '''
+    '''
+    if not cluster_distance:
+        return [geom]
+    
+    # roughly, since a degree of longitude shrinks away from the equator
+    distance = cluster_distance / 111319.49
+    
+    lines = list(getattr(geom, 'geoms', [geom]))
+    clusters = cluster_lines(lines, distance)
+    
+    return [MultiLineString(cluster) for cluster in clusters]
+
+def street_id(name, highway, geom):
+    ''' Stable feature ID from a street's name, highway type, and geometry.
+        
+        The same street gets the same ID from one extract to the next,
+        so its features can be matched up between runs. Streets don't
+        go through the skeleton cache in route-labels/process-routes.py.
+    '''
+    hash = sha1()
+    
+    for value in (name, highway):
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        
+        hash.update(str(value) + '\x00')
+    
+    hash.update(geom.wkb)
+    
+    return hash.hexdigest()
+
+def output_geojson_bzipped(index, streets, cluster_distance=None):
+    '''
+    '''
+    count, output, digest = 0, None, None
+    
+    if isinstance(streets, basestring):
+        # the name of a spool file, see spool_records()
+        streets = unspool_records(streets)
+    
+    def features():
+        for (name, kind, highway, geom) in streets:
+            properties = dict(name=short_street_name(name), long_name=name, kind=kind, highway=highway)
+            
+            # same-name streets far apart become separate features
+            for part in split_multiline(decoded_geometry(geom), cluster_distance):
+                yield dict(type='Feature', id=street_id(name, highway, part), properties=properties, geometry=part.__geo_interface__)
+    
+    try:
+        output = CompressedOutput('streets-%06d.json.bz2' % index)
+        
+        # streets can be any iterable, including a generator from a named cursor
+        count = write_feature_collection(output, features(), '%.6f')
         output.close()
+        digest = output.hexdigest()
+    
+    except Exception, e:
+        if output is not None and output.thread.is_alive():
+            output.close()
+        
+        return index, count, e, digest
+    
+    return index, count, True, digest
+
+def connect_worker(dbname, opts):
+    '''
+    '''
+    global worker_db
+    
+    worker_db = connect(host=opts.host, database=dbname, user=opts.user, password=opts.passwd)
+    worker_db = worker_db.cursor()
+
+def extract_chunk(opts, index, low_street, high_street):
+    '''
+    '''
+    #
+    # Fetch and encode one chunk on this worker's own connection,
+    # see connect_worker(). Ranges from generate_bookends() never
+    # overlap, so workers don't need to coordinate with each other.
+    #
+    try:
+        streets = get_street_multilines(worker_db, opts, low_street, high_street)
+        result = output_geojson_bzipped(index, streets, opts.cluster_distance)
     
     except Exception, e:
-        return index, len(streets), e
+        result = index, 0, e, None
+    
+    # don't hold a snapshot open between chunks
+    worker_db.connection.rollback()
     
-    return index, len(streets), True
+    return result
 
 optparser = OptionParser(usage="""%prog [options] <database>""")
 
-defaults = dict(host='localhost', user='osm2pgsql', passwd=None, table='planet_osm_line', count=5000)
+defaults = dict(host='localhost', user='osm2pgsql', passwd=None, table='planet_osm_line', count=5000, itersize=None, jobs=6, in_flight=12, transport='shapely', connections=None, chunk_cost='rows', target_cost=None, cluster_distance=None, bbox=None, mask_file=None, manifest=None, previous_manifest=None, chunk_prefix='', fingerprint=None)
 
 optparser.set_defaults(**defaults)
 
@@ -240,37 +475,144 @@ optparser.add_option('-p', '--passwd', dest='passwd',
 optparser.add_option('-t', '--table', dest='table',
                      help='Osm2psql lines table name, default "%(table)s".' % defaults)
 
+optparser.add_option('-b', '--bbox', dest='bbox',
+                     help='Only extract streets in this "west,south,east,north" box, in degrees.')
+
+optparser.add_option('-m', '--mask-file', dest='mask_file',
+                     help='Only extract streets in the polygons of this GeoJSON or WKT file, in degrees.')
+
+optparser.add_option('-i', '--itersize', dest='itersize', type='int',
+                     help='Stream street rows through a server-side cursor, fetching this many at a time. Each chunk is then written in this process as rows arrive, instead of being fetched whole and sent to the pool.')
+
+optparser.add_option('-j', '--jobs', dest='jobs', type='int',
+                     help='Number of encoding processes, default %(jobs)d.' % defaults)
+
+optparser.add_option('-f', '--in-flight', dest='in_flight', type='int',
+                     help='Most chunks fetched but not yet written, or name groups read ahead when streaming, default %(in_flight)d.' % defaults)
+
+optparser.add_option('--transport', dest='transport', type='choice', choices=('shapely', 'wkb', 'file'),
+                     help='How chunks get to the encoding processes: pickled "shapely" geometries, raw "wkb" buffers decoded by the encoders, or "file" to spool WKB to shared memory and send just the file name. Default "%(transport)s".' % defaults)
+
+optparser.add_option('--chunk-cost', dest='chunk_cost', type='choice', choices=('rows', 'points', 'length'),
+                     help='Balance chunks by number of "rows", total vertex count in "points", or total "length" of street geometry. Default "%(chunk_cost)s".' % defaults)
+
+optparser.add_option('--target-cost', dest='target_cost', type='float',
+                     help='Chunk cost to aim for, default %(count)d rows or about as many chunks as that makes.' % defaults)
+
+optparser.add_option('--cluster-distance', dest='cluster_distance', type='float',
+                     help='Split each same-name street group into separate features wherever its ways are more than this many meters apart.')
+
+optparser.add_option('--connections', dest='connections', type='int',
+                     help='Fetch and encode chunks in this many processes, each with its own database connection, instead of fetching every chunk here. The street table becomes an unlogged table so they can all see it.')
+
+optparser.add_option('--manifest', dest='manifest',
+                     help='Write a manifest of chunk digests and locations to this file.')
+
+optparser.add_option('--previous-manifest', dest='previous_manifest',
+                     help='Manifest from an earlier run. Chunks are cut where they were cut then, and chunks that come out the same are removed and listed by their old location in the new manifest.')
+
+optparser.add_option('--chunk-prefix', dest='chunk_prefix',
+                     help='Where the chunks from this run will be uploaded, recorded as their location in the manifest, e.g. "2013-01-01-streets/streets-geojson/".')
+
+optparser.add_option('--fingerprint', dest='fingerprint',
+                     help='Anything that identifies how chunks will be processed, e.g. a hash of the processing scripts, recorded in the manifest. No chunks are carried forward from a previous manifest with a different fingerprint.')
+
 if __name__ == '__main__':
 
     opts, (dbname, ) = optparser.parse_args()
     
+    if opts.previous_manifest and not opts.manifest:
+        optparser.error('--previous-manifest needs a --manifest to write.')
+    
     logging.basicConfig(level=logging.DEBUG, format='%(levelname)08s - %(message)s')
     
     db = connect(host=opts.host, database=dbname, user=opts.user, password=opts.passwd)
     db = db.cursor()
     
     #
-    # Build temporary table with street IDs
+    # A table name of this run's own, so that other extracts against
+    # the same database can't drop it out from under this one.
     #
-    build_temporary_tables(db, opts)
+    opts.street_table = 'street_ids_%s' % uuid1().hex
     
-    #
-    # Ship everything off to be bzipped
-    #
-    bookends = generate_bookends(db, opts)
-    pool = Pool(6)
-    
-    for ((low_street, high_street), index) in izip(bookends, count(1)):
-        streets = get_street_multilines(db, opts, low_street, high_street)
+    try:
+        #
+        # Build temporary table with street IDs
+        #
+        build_temporary_tables(db, opts)
+        
+        #
+        # Ship everything off to be bzipped
+        #
+        previous, fingerprint = load_manifest(opts.previous_manifest)
+        boundaries = set([chunk['low'].encode('utf8') for chunk in previous.values()])
+        
+        if previous and fingerprint != opts.fingerprint:
+            # cut in the same places, but outputs from before can't be reused
+            logging.info('Processing fingerprint has changed, carrying no chunks forward')
+            previous = dict()
+        
+        bookends = generate_bookends(db, opts, boundaries)
+        chunks = dict()
+        
+        if opts.connections:
+            pool = Pool(opts.connections, connect_worker, (dbname, opts))
+        else:
+            pool = Pool(opts.jobs)
+        
+        #
+        # Each chunk takes a slot before it's fetched and gives it back once
+        # written, so the database can't get more than opts.in_flight chunks
+        # ahead of the encoders and memory stays flat over the whole planet.
+        #
+        in_flight = BoundedSemaphore(opts.in_flight)
         
-        def callback((index, count, status)):
+        def callback((index, count, status, digest)):
+            in_flight.release()
+            
             if status is True:
                 logging.info('%(index)d. Wrote %(count)d streets' % locals())
+                chunks['streets-%06d.json.bz2' % index].update(digest=digest, count=count)
             else:
                 logging.info('%(index)d. Failed: %(status)s' % locals())
+                del chunks['streets-%06d.json.bz2' % index]
+        
+        for ((low_street, high_street), index) in izip(bookends, count(1)):
+            in_flight.acquire()
+            chunks['streets-%06d.json.bz2' % index] = dict(low=low_street, high=high_street)
+            
+            if opts.connections:
+                pool.apply_async(extract_chunk, (opts, index, low_street, high_street), callback=callback)
+                continue
+            
+            streets = get_street_multilines(db, opts, low_street, high_street)
+            
+            if opts.itersize:
+                # a generator from a named cursor can't be sent to the pool
+                streets = prefetched(streets, opts.in_flight)
+                
+                try:
+                    callback(output_geojson_bzipped(index, streets, opts.cluster_distance))
+                finally:
+                    # stops the fetch thread and closes the cursor if encoding stopped early
+                    streets.close()
+            else:
+                if opts.transport == 'file':
+                    streets = spool_records(streets)
+                
+                pool.apply_async(output_geojson_bzipped, (index, streets, opts.cluster_distance), callback=callback)
         
-        pool.apply_async(output_geojson_bzipped, (index, streets), callback=callback)
+        pool.close()
+        pool.join()
+        
+        if opts.manifest:
+            update_manifest(opts.manifest, previous, chunks, opts.chunk_prefix, opts.fingerprint)
+    
+    finally:
+        if opts.connections:
+            # the unlogged table was committed, so it outlives a failed run
+            db.execute('ROLLBACK')
+            db.execute('DROP TABLE IF EXISTS %s' % opts.street_table)
+            db.execute('COMMIT')
         
-    db.close()
-    pool.close()
-    pool.join()
+        db.close()
@@ -0,0 +1 @@
+../route-labels/extracttools.py
\ No newline at end of file
@@ -0,0 +1 @@
+../route-labels/geojsonwriter.py
\ No newline at end of file
@@ -8,7 +8,14 @@ DIR=`date +%Y-%m-%d`-streets
 mkdir -p $DIR/streets-geojson
 mkdir -p $DIR/streets-geojson-100th
 
-python extract-streets.py -u osm2pgsql -p osm2pgsqlpassword osm2pgsql
+# a change to how chunks get processed means nothing can be carried forward
+FINGERPRINT=`cat process-streets.py launch-streets.py | sha1sum | cut -d' ' -f1`
+
+# unchanged chunks are left out of $DIR and listed in its manifest instead,
+# see remote-run.sh for where streets-manifest.json comes from
+python extract-streets.py --previous-manifest streets-manifest.json \
+    --manifest $DIR/manifest.json --chunk-prefix $DIR/streets-geojson/ \
+    --fingerprint $FINGERPRINT -u osm2pgsql -p osm2pgsqlpassword osm2pgsql
 
 ln -f setup.sh $DIR/
 ln -f process-streets.py $DIR/
@@ -22,5 +22,8 @@ python launch-streets.py osm-streets-routes-data $DIR
 echo "Verifying output (verify-streets)..."
 python verify-streets.py osm-streets-routes-data/$DIR/streets-geojson/ osm-streets-routes-data/$DIR/output/
 
+# every chunk in this run has outputs now, so later runs can carry them forward
+cp $DIR/manifest.json streets-manifest.json
+
 echo "Downloading street data (download-streets)..."
-python download-streets.py -u gis -p gis osm-streets-routes-data/$DIR/output/ gis
+python download-streets.py -m $DIR/manifest.json -u gis -p gis osm-streets-routes-data/$DIR/output/ gis
@@ -0,0 +1,91 @@
+''' Tests for extract-streets.py against a scratch PostGIS database.
+
+Run with "python test-extract-streets.py", with the database named by
+the usual PGDATABASE, PGHOST and PGUSER environment variables. Tests
+are skipped if there's no database to connect to.
+'''
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import getcwd, chdir
+from uuid import uuid1
+
+import unittest
+
+from psycopg2 import connect, OperationalError
+
+extract = __import__('extract-streets')
+
+#
+# Ways as (osm_id, name, highway, well-known text) in spherical mercator,
+# with several ways to most name groups so that their order matters.
+#
+ways = [
+    (1, 'Main Street', 'primary', 'LINESTRING(0 0, 100 0)'),
+    (2, 'Main Street', 'primary', 'LINESTRING(100 0, 200 10)'),
+    (3, 'Main Street', 'primary', 'LINESTRING(5000 5000, 5100 5000)'),
+    (4, 'Main Street', 'secondary', 'LINESTRING(200 10, 300 10)'),
+    (5, 'Oak Avenue', 'secondary', 'LINESTRING(0 100, 0 200)'),
+    (6, 'Oak Avenue', 'secondary', 'LINESTRING(0 200, 10 300)'),
+    (7, 'Pine Road', 'tertiary', 'LINESTRING(50 50, 60 70)')
+    ]
+
+class ExtractStreetsTests (unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.db = connect('').cursor()
+        except OperationalError, e:
+            self.skipTest('No database: %s' % e)
+        
+        self.cwd, self.path = getcwd(), mkdtemp(prefix='test-extract-streets-')
+        chdir(self.path)
+    
+    def tearDown(self):
+        chdir(self.cwd)
+        rmtree(self.path)
+        
+        self.db.execute('ROLLBACK')
+        self.db.connection.close()
+    
+    def extract_digests(self, ways, *args):
+        ''' Load ways into a fresh lines table in the given order, and extract it.
+        '''
+        opts, args = extract.optparser.parse_args(['--table', 'test_lines', '--count', '2'] + list(args) + ['db'])
+        opts.street_table = 'street_ids_%s' % uuid1().hex
+        
+        self.db.execute('DROP TABLE IF EXISTS test_lines')
+        self.db.execute('CREATE TEMPORARY TABLE test_lines (osm_id INTEGER, name TEXT, highway TEXT, way GEOMETRY)')
+        
+        for (osm_id, name, highway, wkt) in ways:
+            self.db.execute('''INSERT INTO test_lines
+                               VALUES (%s, %s, %s, SetSrid(GeomFromText(%s), 900913))''', (osm_id, name, highway, wkt))
+        
+        extract.build_temporary_tables(self.db, opts)
+        digests = []
+        
+        for (index, (low_street, high_street)) in enumerate(extract.generate_bookends(self.db, opts)):
+            streets = extract.get_street_multilines(self.db, opts, low_street, high_street)
+            index, count, status, digest = extract.output_geojson_bzipped(index, streets, opts.cluster_distance)
+            
+            self.assertTrue(status is True, status)
+            digests.append(digest)
+        
+        return digests
+    
+    def test_same_digests(self):
+        ''' The same ways in a different physical order make the same chunks.
+        '''
+        self.assertEqual(self.extract_digests(ways), self.extract_digests(list(reversed(ways))))
+    
+    def test_same_digests_streaming(self):
+        ''' Same as above, through a server-side cursor.
+        '''
+        self.assertEqual(self.extract_digests(ways, '--itersize', '2'), self.extract_digests(list(reversed(ways)), '--itersize', '2'))
+    
+    def test_same_digests_clustered(self):
+        ''' Same as above, with same-name streets split into clusters.
+        '''
+        self.assertEqual(self.extract_digests(ways, '--cluster-distance', '500'), self.extract_digests(list(reversed(ways)), '--cluster-distance', '500'))
+
+if __name__ == '__main__':
+    unittest.main()